@@ -0,0 +1,84 @@
+"""Queue of the register writes requested through /control, waiting for the inverter"""
+
+import glob
+import heapq
+import itertools
+import os
+import threading
+import time
+
+
+class ControlRequest:
+    """Registers to write for one /control call, and the outcome once it has been sent"""
+
+    def __init__(self, writes, priority):
+        self.writes = writes
+        self.priority = priority
+        self.results = None  # {register: value read back, or None if unconfirmed}
+        self.retry_after = None  # seconds until the rate limit allows these registers again
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def finish(self, results=None, retry_after=None):
+        self.results = results
+        self.retry_after = retry_after
+        self.done.set()
+
+
+class WriteQueue:
+    """Pending control writes of this worker, lowest priority number first, then in arrival order
+
+    While writes are pending a flag file next to the snapshot exists, so that a poll cycle running
+    in any worker stops early and gives up the logger to the writes. A request that is not sent
+    within timeout seconds is dropped, so older flags are left over from a worker that died.
+    """
+
+    def __init__(self, snapshot_path, timeout):
+        self.timeout = timeout
+        self.flag_pattern = f'{snapshot_path}.write.*'
+        self.flag_path = f'{snapshot_path}.write.{os.getpid()}'
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def submit(self, writes, priority):
+        """Queue {register: value} and wait for it to be sent; the request is dropped after the timeout"""
+        request = ControlRequest(writes, priority)
+        with self.condition:
+            heapq.heappush(self.heap, (priority, next(self.counter), request))
+            open(self.flag_path, 'a').close()
+            os.utime(self.flag_path)
+            self.condition.notify_all()
+
+        if not request.done.wait(self.timeout):
+            with self.condition:
+                # Not sent if still queued; if it is being sent already, the outcome stays unknown
+                request.cancelled = True
+        return request
+
+    def pop(self):
+        """Return the next request to send, or None when the queue is empty"""
+        with self.condition:
+            while self.heap:
+                request = heapq.heappop(self.heap)[2]
+                if not request.cancelled:
+                    return request
+            if os.path.exists(self.flag_path):
+                os.remove(self.flag_path)
+            return None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a request to be queued; returns whether one is pending"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.heap, timeout)
+
+    def pending_anywhere(self):
+        """Whether writes are pending in any worker"""
+        now = time.time()
+        for path in glob.glob(self.flag_pattern):
+            try:
+                if now - os.path.getmtime(path) < self.timeout:
+                    return True
+            except FileNotFoundError:
+                pass
+        return False
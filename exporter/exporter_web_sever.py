@@ -1,25 +1,288 @@
 #!/usr/bin/python3
 
-from flask import Flask, Response
-import subprocess
+from flask import Flask, Response, jsonify, request
+from control import WriteQueue
+from timeseries import History
+import configparser
+import importlib.util
 import os
+import tempfile
+import threading
+import time
 
 current_directory = os.path.dirname(os.path.abspath(__file__))
 sofar_monitor_file = os.path.join(current_directory, "../sofar-monitor.py")
+config_file = os.path.join(current_directory, "../config.cfg")
+
+
+def load_sofar_monitor():
+    """Import sofar-monitor.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_monitor", sofar_monitor_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_exporter_config(config_path=config_file):
+    """Load the optional [Exporter] settings"""
+    configParser = configparser.RawConfigParser()
+    configParser.read(config_path)
+
+    poll_interval = configParser.getfloat('Exporter', 'poll_interval', fallback=10)
+    return {
+        'poll_interval': poll_interval,
+        'snapshot_path': configParser.get('Exporter', 'snapshot_path',
+                                          fallback=os.path.join(tempfile.gettempdir(), 'sofar-snapshot.json')),
+        'snapshot_ttl': configParser.getfloat('Exporter', 'snapshot_ttl', fallback=poll_interval),
+        'backoff_max': configParser.getfloat('Exporter', 'backoff_max', fallback=300),
+        'slow_interval': configParser.getfloat('Exporter', 'slow_interval', fallback=60),
+        'static_interval': configParser.getfloat('Exporter', 'static_interval', fallback=3600),
+        'history_hours': configParser.getfloat('Exporter', 'history_hours', fallback=6),
+        'archive_path': configParser.get('Exporter', 'archive_path', fallback=None),
+        'control': configParser.getboolean('Exporter', 'control', fallback=False),
+        'write_interval': configParser.getfloat('Exporter', 'write_interval', fallback=10),
+        'control_timeout': configParser.getfloat('Exporter', 'control_timeout', fallback=10),
+    }
+
+
+sofar = load_sofar_monitor()
+
+
+class Poller:
+    """Keeps the shared snapshot warm from a background thread in every worker"""
+
+    def __init__(self, config, store, interval, tier_intervals, history, writes, write_interval, archive=None):
+        self.config = config
+        self.name = config['name']
+        self.store = store
+        self.interval = interval
+        self.history = history
+        self.writes = writes
+        self.write_interval = write_interval
+        # When every register was last written, shared by all workers for the rate limit
+        self.write_times_path = store.path + '.writes'
+        self.archive = archive
+        self.verbose = config['verbose'] == "1"
+        self.tier_plans = sofar.plan_tiers(config)
+        # The fast tier is read on every cycle
+        self.tier_intervals = dict(tier_intervals, fast=0)
+        self.thread = threading.Thread(target=self.run, name=f"sofar-poller-{self.name}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def poll(self, state):
+        """Run one poll cycle; only ever called by the worker holding the snapshot lock
+
+        Only the tiers that are due are read; the registers of the other tiers are taken from the
+        last complete read of that tier, kept in state. A cycle in which a range of a due tier could
+        not be read has failed, so the last good snapshot is served, flagged stale. A cycle that
+        stops early for writes returns POLL_YIELDED and is run again in full once they have been sent.
+        """
+        started = time.monotonic()
+        self.yielded = False
+        last_polled = dict(state.get('tiers', {}))
+        # A tier holding a register written since its last read is read again right away
+        for reg, written in sofar.load_write_times(self.write_times_path).items():
+            for tier, plan in self.tier_plans.items():
+                if written > last_polled.get(tier, 0) and any(start <= reg < start + count for start, count in plan):
+                    last_polled[tier] = 0
+        tiers = sofar.due_tiers(self.tier_plans, last_polled, self.tier_intervals, time.time())
+        plan = sorted(reg_range for tier in tiers for reg_range in self.tier_plans[tier])
+
+        # The logger serves one client reliably, so the connection is not kept between cycles
+        # that may be run by different workers
+        with sofar.InverterSession(self.config['inverter_ip'], self.config['inverter_port'], verbose=self.verbose) as session:
+            values = sofar.poll_registers(session, self.config['inverter_sn'], plan, self.verbose,
+                                          budget=self.config['cycle_timeout'], before_range=self.before_range)
+        if self.yielded:
+            return sofar.POLL_YIELDED
+
+        data = None
+        if all(start in values for start, count in plan):
+            decode_started = time.perf_counter()
+            image = sofar.register_image_from_dict(state.get('registers', {}))
+            for start, words in sofar.register_blocks(values):
+                image.update(start, words)
+            data = sofar.format_data(image)
+            session.stats['decode_seconds'] += time.perf_counter() - decode_started
+
+            state['registers'] = sofar.register_image_to_dict(image)
+            if self.archive is not None:
+                self.archive.append(time.time(), image)
+            for tier in tiers:
+                state.setdefault('tiers', {})[tier] = time.time()
+
+        sofar.add_cycle_stats(state.setdefault('stats', {}), session.stats, time.monotonic() - started,
+                              failed=data is None)
+        return data
+
+    def before_range(self, session):
+        """Send the queued writes ahead of the remaining reads of the cycle
+
+        The cycle stops early while writes are pending in another worker, so that worker gets the
+        logger; the snapshot is left as it is and the cycle is run again on the next check.
+        """
+        self.send_writes(session)
+        self.yielded = self.writes.pending_anywhere()
+        return not self.yielded
+
+    def send_writes(self, session):
+        """Send the queued writes over an open session; only called while holding the snapshot lock"""
+        while (request := self.writes.pop()) is not None:
+            results, retry_after = sofar.write_registers_limited(session, self.config, request.writes,
+                                                                 self.write_times_path, self.write_interval,
+                                                                 self.verbose)
+            request.finish(results, retry_after or None)
+
+    def send_queued_writes(self):
+        """Send the writes queued while no cycle was running in this worker"""
+        with self.store.lock():
+            with sofar.InverterSession(self.config['inverter_ip'], self.config['inverter_port'], verbose=self.verbose) as session:
+                self.send_writes(session)
+
+    def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                snapshot = self.store.refresh(self.poll)
+                # Every worker keeps its own history of the snapshots, whoever polled them
+                if snapshot is not None and snapshot['data'] is not None:
+                    self.history.add(snapshot['timestamp'], snapshot['data'])
+            except Exception as e:
+                print(f"Poll error ({self.name}): {e}")
+            # Check the shared snapshot several times per interval, so the history misses none of them,
+            # and send the writes queued in the meantime as soon as they arrive
+            while self.writes.wait(max(0, self.interval / 4 - (time.monotonic() - started))):
+                try:
+                    self.send_queued_writes()
+                except Exception as e:
+                    print(f"Write error ({self.name}): {e}")
+
+
+exporter_config = load_exporter_config()
+inverters = sofar.load_inverters(config_file)
+if not inverters:
+    raise SystemExit("No [SofarInverter] section in config.cfg")
+
+# Every inverter is polled by a poller of its own, with its own snapshot, history, write queue and
+# archive; with several inverters their files carry the inverter name
+pollers = {}
+for inverter in inverters:
+    snapshot_path = sofar.inverter_path(exporter_config['snapshot_path'], inverter, inverters)
+    store = sofar.SnapshotStore(snapshot_path, exporter_config['snapshot_ttl'], exporter_config['backoff_max'])
+    history = History(exporter_config['history_hours'], exporter_config['poll_interval'])
+    # Every worker opens the archive, but only the one that polled appends; the archive's own lock
+    # keeps a worker starting up from cutting a record another one is writing
+    archive = None
+    if exporter_config['archive_path']:
+        archive = sofar.RegisterArchive(sofar.inverter_path(exporter_config['archive_path'], inverter, inverters))
+    writes = WriteQueue(snapshot_path, exporter_config['control_timeout'])
+    pollers[inverter['name']] = Poller(inverter, store, exporter_config['poll_interval'],
+                                       {'slow': exporter_config['slow_interval'],
+                                        'static': exporter_config['static_interval']},
+                                       history, writes, exporter_config['write_interval'], archive)
+for poller in pollers.values():
+    poller.start()
+
+# Prometheus text of the last snapshot of every inverter served by this worker and the seconds it
+# took to render: {inverter name: (snapshot timestamp, text, seconds)}
+rendered = {}
 
 app = Flask(__name__)
 
 
+def select_poller(name):
+    """Return the poller of the inverter called name (see select_inverter()); raises ValueError if there is none"""
+    return pollers[sofar.select_inverter(inverters, name)['name']]
+
+
+def inverter_metrics(poller, inverter_label):
+    """Return the metrics of one inverter, or None while it has no data"""
+    snapshot = poller.store.read()
+    if snapshot is None or snapshot['data'] is None:
+        return None
+
+    timestamp, text, render_seconds = rendered.get(poller.name, (None, None, 0))
+    if timestamp != snapshot['timestamp']:
+        render_started = time.perf_counter()
+        text = sofar.format_prometheus(snapshot['data'], inverter_name="sofar", inverter_label=inverter_label)
+        render_seconds = time.perf_counter() - render_started
+        rendered[poller.name] = (snapshot['timestamp'], text, render_seconds)
+    poll_metrics = sofar.format_poll_metrics(snapshot.get('state', {}).get('stats', {}))
+
+    # While the logger is unreachable the last good data is served, flagged as stale
+    age = time.time() - snapshot['timestamp']
+    stale = int(age > poller.store.ttl or snapshot.get('failures', 0) > 0)
+    return text + "\n" + sofar.add_inverter_label(f'sofar{{stats="snapshot_age"}} {age:.3f}\n'
+                                                  f'sofar{{stats="stale"}} {stale}\n'
+                                                  f'sofar{{stats="poll_failures"}} {snapshot.get("failures", 0)}\n'
+                                                  f'{poll_metrics}\n'
+                                                  f'sofar{{poll="render_seconds"}} {render_seconds:g}\n',
+                                                  inverter_label)
+
+
 @app.route('/metrics')
 def metrics():
-    # Run the `sofar-monitor.py` script with --format=prometheus and capture the output
-    result = subprocess.run(
-        [sofar_monitor_file, "--format=prometheus"],
-        capture_output=True,
-        text=True
-    )
-    # Return the output in Prometheus format
-    return Response(result.stdout, mimetype='text/plain')
+    # Serve the latest snapshots collected by whichever worker polled last; with several
+    # inverters every metric carries an inverter label
+    fleet = len(pollers) > 1
+    texts = [inverter_metrics(poller, poller.name if fleet else None) for poller in pollers.values()]
+    texts = [text for text in texts if text is not None]
+    if not texts:
+        return Response("No data received from inverter\n", status=503, mimetype='text/plain')
+    return Response("".join(texts), mimetype='text/plain')
+
+
+@app.route('/history')
+def history_query():
+    # Recent values of one metric, e.g. /history?metric=pv1.power&minutes=10&resolution=1m&inverter=roof
+    try:
+        history = select_poller(request.args.get('inverter')).history
+    except ValueError as e:
+        return jsonify(error=str(e)), 404
+    metric = request.args.get('metric')
+    if metric is None:
+        return jsonify(metrics=history.metrics())
+
+    minutes = request.args.get('minutes', 60, type=float)
+    resolution = request.args.get('resolution', 'raw')
+    try:
+        points = history.query(metric, time.time() - minutes * 60, resolution)
+    except KeyError:
+        return jsonify(error=f"Unknown metric {metric} or resolution {resolution}"), 404
+    return jsonify(metric=metric, resolution=resolution, points=points)
+
+
+@app.route('/control', methods=['POST'])
+def control():
+    # Write registers, e.g. {"registers": {"0x104D": 20, "0x104E": 90}, "priority": 0, "inverter": "roof"}
+    if not exporter_config['control']:
+        return jsonify(error="Writes are disabled, set control=1 in [Exporter]"), 403
+    body = request.get_json(silent=True) or {}
+    try:
+        registers = {int(reg, 0): int(value) for reg, value in body['registers'].items()}
+        priority = int(body.get('priority', 0))
+    except (KeyError, AttributeError, TypeError, ValueError):
+        return jsonify(error='Expected {"registers": {"0x104D": 20, ...}, "priority": 0}'), 400
+    try:
+        writes = select_poller(body.get('inverter')).writes
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if not registers or not all(0 <= reg <= 0xFFFF and 0 <= value <= 0xFFFF for reg, value in registers.items()):
+        return jsonify(error="Registers and values must be between 0 and 0xFFFF"), 400
+
+    sent = writes.submit(registers, priority)
+    if not sent.done.is_set():
+        return jsonify(error=f"Not sent within {exporter_config['control_timeout']:g}s"), 504
+    if sent.retry_after is not None:
+        response = jsonify(error=f"Written less than {exporter_config['write_interval']:g}s ago")
+        response.headers['Retry-After'] = str(int(sent.retry_after) + 1)
+        return response, 429
+
+    confirmed = all(sent.results[reg] == value for reg, value in registers.items())
+    return jsonify(registers={f"0x{reg:04X}": sent.results[reg] for reg in sorted(registers)},
+                   confirmed=confirmed), 200 if confirmed else 502
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=9092)
@@ -0,0 +1,140 @@
+"""In-memory history of the decoded inverter values, with min/max/avg rollups"""
+
+import bisect
+import math
+import threading
+from array import array
+
+# Rollup resolutions: (name, seconds per bucket, number of buckets kept)
+ROLLUPS = (('1m', 60, 24 * 60), ('15m', 900, 7 * 24 * 4))
+
+
+def flatten(data, prefix=""):
+    """Yield (dotted path, value) for every numeric value of a decoded snapshot"""
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, path + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+class RingBuffer:
+    """Fixed number of timestamped rows, one float array per column; the oldest row is overwritten"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', [math.inf]) * capacity
+        self.columns = {}
+        self.next = 0
+        self.size = 0
+
+    def append(self, timestamp, values):
+        """Append a row; columns missing from values are stored as NaN"""
+        i = self.next
+        self.times[i] = timestamp
+        for name, column in self.columns.items():
+            column[i] = values.get(name, math.nan)
+        for name in values.keys() - self.columns.keys():
+            column = self.columns[name] = array('d', [math.nan]) * self.capacity
+            column[i] = values[name]
+        self.next = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def segments(self):
+        """Return the (lo, hi) index ranges holding the rows, oldest first"""
+        if self.size < self.capacity:
+            return [(0, self.size)]
+        return [(self.next, self.capacity), (0, self.next)]
+
+    def rows(self, since):
+        """Yield the indexes of the rows at or after since, oldest first"""
+        # Rows are in time order within each segment, so the first one to return is found by bisection
+        for lo, hi in self.segments():
+            yield from range(bisect.bisect_left(self.times, since, lo, hi), hi)
+
+
+class Rollup:
+    """Aggregates values into fixed time buckets and keeps min, max and average per bucket"""
+
+    def __init__(self, step, capacity):
+        self.step = step
+        self.buffer = RingBuffer(capacity)
+        self.bucket = None
+        self.pending = {}  # name: [min, max, sum, count] of the open bucket
+
+    def add(self, timestamp, values):
+        bucket = timestamp - timestamp % self.step
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        for name, value in values.items():
+            acc = self.pending.get(name)
+            if acc is None:
+                self.pending[name] = [value, value, value, 1]
+            else:
+                acc[0] = min(acc[0], value)
+                acc[1] = max(acc[1], value)
+                acc[2] += value
+                acc[3] += 1
+
+    def flush(self):
+        """Close the open bucket"""
+        if self.pending:
+            row = {}
+            for name, (low, high, total, count) in self.pending.items():
+                row[(name, 'min')], row[(name, 'max')], row[(name, 'avg')] = low, high, total / count
+            self.buffer.append(self.bucket, row)
+        self.pending = {}
+
+    def points(self, name, since):
+        """Return [bucket start, min, max, avg] for the closed buckets and the open one"""
+        columns = [self.buffer.columns.get((name, stat)) for stat in ('min', 'max', 'avg')]
+        points = []
+        if columns[0] is not None:
+            for i in self.buffer.rows(since):
+                if not math.isnan(columns[2][i]):
+                    points.append([self.buffer.times[i], columns[0][i], columns[1][i], columns[2][i]])
+        acc = self.pending.get(name)
+        if acc is not None and self.bucket >= since:
+            points.append([self.bucket, acc[0], acc[1], acc[2] / acc[3]])
+        return points
+
+
+class History:
+    """Recent snapshots at full poll resolution, plus the rollups in ROLLUPS"""
+
+    def __init__(self, hours, poll_interval):
+        self.raw = RingBuffer(max(1, int(hours * 3600 / poll_interval)))
+        self.rollups = {name: Rollup(step, capacity) for name, step, capacity in ROLLUPS}
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, data):
+        """Record a decoded snapshot; snapshots already recorded are ignored"""
+        with self.lock:
+            if self.last is not None and timestamp <= self.last:
+                return
+            self.last = timestamp
+            values = dict(flatten(data))
+            self.raw.append(timestamp, values)
+            for rollup in self.rollups.values():
+                rollup.add(timestamp, values)
+
+    def metrics(self):
+        """Return the names of all recorded values"""
+        with self.lock:
+            return sorted(self.raw.columns)
+
+    def query(self, name, since, resolution="raw"):
+        """Return the points of a value since a time: [time, value] for raw, [time, min, max, avg] for rollups
+
+        Raises KeyError for an unknown value or resolution.
+        """
+        with self.lock:
+            if name not in self.raw.columns:
+                raise KeyError(name)
+            if resolution != "raw":
+                return self.rollups[resolution].points(name, since)
+            column = self.raw.columns[name]
+            return [[self.raw.times[i], column[i]] for i in self.raw.rows(since) if not math.isnan(column[i])]
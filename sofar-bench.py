@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sofar_simulator_file = os.path.join(current_directory, "sofar-simulator.py")
+samples_directory = os.path.join(current_directory, "samples")
+
+# Any serial number will do, it only ends up in the request frames
+INVERTER_SN = 2712345678
+
+
+def load_sofar_simulator():
+    """Import sofar-simulator.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_simulator", sofar_simulator_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+simulator = load_sofar_simulator()
+sofar = simulator.sofar
+
+
+def sample_stages(image):
+    """Return (stage name, function) pairs running one poll's worth of each hot path stage on image"""
+    plan = sofar.plan_ranges(sofar.DECODER_REGISTERS)
+    responses = [(simulator.read_response(sofar.create_frame(INVERTER_SN, start, count), image, start, count),
+                  start, count) for start, count in plan]
+    decoded = sofar.RegisterImage()
+    for response, start, count in responses:
+        sofar.process_response(response, start, count, image=decoded)
+    data = sofar.format_data(decoded)
+    devnull = open(os.devnull, 'w')
+
+    def create_frames():
+        for start, count in plan:
+            sofar.create_frame(INVERTER_SN, start, count, sequence=0x1234)
+
+    def process_responses():
+        for response, start, count in responses:
+            sofar.process_response(response, start, count, image=decoded)
+
+    def print_text():
+        with redirect_stdout(devnull):
+            sofar.print_data(data)
+
+    return [
+        ("create_frame", create_frames),
+        ("process_response", process_responses),
+        ("format_data", lambda: sofar.format_data(decoded)),
+        ("interpret_fault_codes", lambda: sofar.interpret_fault_codes(decoded)),
+        ("format_prometheus", lambda: sofar.format_prometheus(data, inverter_name="sofar")),
+        ("json", lambda: json.dumps(data, indent=2)),
+        ("print_data", print_text),
+    ]
+
+def ops_per_second(func, min_time, repeat=3):
+    """Best rate of func over repeat timing runs that each last at least min_time seconds"""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - started)
+    return number / best
+
+def peak_allocation(func):
+    """Return the peak bytes allocated while running func once"""
+    func()  # warm up caches, so only the steady state is measured
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+def allocations(func, repeat=3):
+    """Return the memory blocks one run of func leaves allocated, its result included
+
+    Blocks freed again before func returns are not counted. The lowest count of several runs is
+    taken, with the garbage collector paused, so that unrelated allocations do not show up.
+    """
+    func()  # warm up caches, so only the steady state is measured
+    counts = []
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            before = sys.getallocatedblocks()
+            result = func()
+            counts.append(sys.getallocatedblocks() - before)
+            del result
+    finally:
+        gc.enable()
+    return max(0, min(counts))
+
+def run(samples, stages, min_time):
+    """Benchmark the stages on every sample: {sample: {stage: {ops, peak, allocs}}}"""
+    results = {}
+    for name in samples:
+        image = sofar.load_register_image(os.path.join(samples_directory, f"{name}.json"))
+        results[name] = {}
+        for stage, func in sample_stages(image):
+            if stages and stage not in stages:
+                continue
+            results[name][stage] = {'ops': ops_per_second(func, min_time), 'peak': peak_allocation(func),
+                                    'allocs': allocations(func)}
+    return results
+
+def print_results(results, baseline=None):
+    """Print a table of the results, with the speed change against a baseline if given"""
+    header = f"{'sample':<12} {'stage':<22} {'ops/s':>10} {'us/op':>9} {'peak KiB':>9} {'allocs':>7}"
+    print(header + ("  vs baseline" if baseline else ""))
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            line = (f"{name:<12} {stage:<22} {result['ops']:>10.0f} {1e6 / result['ops']:>9.2f} "
+                    f"{result['peak'] / 1024:>9.1f} {result['allocs']:>7}")
+            previous = (baseline or {}).get(name, {}).get(stage)
+            if previous:
+                line += f"  {(result['ops'] / previous['ops'] - 1) * 100:+6.1f}%"
+            print(line)
+
+def main():
+    samples = sorted(f[:-5] for f in os.listdir(samples_directory) if f.endswith(".json"))
+    stages = [stage for stage, _ in sample_stages(sofar.RegisterImage())]
+
+    parser = argparse.ArgumentParser(description="Benchmark the frame, decode and output stages on sample register images.")
+    parser.add_argument("--sample", action="append", choices=samples, help="Sample image to run (default: all)")
+    parser.add_argument("--stage", action="append", choices=stages, help="Stage to run (default: all)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per timing run")
+    parser.add_argument("--save", metavar="FILE", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="Compare the results against a saved baseline")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run(args.sample or samples, args.stage, args.min_time)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
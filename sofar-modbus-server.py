@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import configparser
+import importlib.util
+import os
+import signal
+import struct
+import sys
+import tempfile
+import time
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sofar_monitor_file = os.path.join(current_directory, "sofar-monitor.py")
+config_file = os.path.join(current_directory, "config.cfg")
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+SLAVE_DEVICE_FAILURE = 0x04
+SLAVE_DEVICE_BUSY = 0x06
+GATEWAY_TARGET_FAILED = 0x0B
+
+
+def load_sofar_monitor():
+    """Import sofar-monitor.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_monitor", sofar_monitor_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_server_config(config_path=config_file):
+    """Load the optional [ModbusServer] settings and the exporter's snapshot path and write interval"""
+    configParser = configparser.RawConfigParser()
+    configParser.read(config_path)
+
+    return {
+        'host': configParser.get('ModbusServer', 'host', fallback='0.0.0.0'),
+        'port': configParser.getint('ModbusServer', 'port', fallback=5020),
+        'max_age': configParser.getfloat('ModbusServer', 'max_age', fallback=60),
+        'writes': configParser.getboolean('ModbusServer', 'writes', fallback=False),
+        'snapshot_path': configParser.get('Exporter', 'snapshot_path',
+                                          fallback=os.path.join(tempfile.gettempdir(), 'sofar-snapshot.json')),
+        'write_interval': configParser.getfloat('Exporter', 'write_interval', fallback=10),
+    }
+
+
+sofar = load_sofar_monitor()
+
+
+class RegisterServer:
+    """Modbus TCP server answering reads from the exporter's snapshot and forwarding writes to the inverter"""
+
+    def __init__(self, config, server_config, verbose=False):
+        self.config = config
+        self.store = sofar.SnapshotStore(server_config['snapshot_path'], ttl=server_config['max_age'])
+        self.max_age = server_config['max_age']
+        self.writes = server_config['writes']
+        self.write_interval = server_config['write_interval']
+        # Shared with the exporter, so a register is not written more often through either of them
+        self.write_times_path = self.store.path + '.writes'
+        # While it exists, a poll cycle of the exporter stops early to give up the logger
+        self.write_flag_path = f'{self.store.path}.write.{os.getpid()}'
+        self.verbose = verbose
+        self.image = (None, None)  # (snapshot timestamp, register image)
+        self.written = {}  # register: (time written, value), until a newer snapshot has it
+        self.write_lock = asyncio.Lock()
+        self.stats = {'clients': 0, 'reads': 0, 'writes': 0, 'exceptions': 0}
+
+    def current_image(self):
+        """Return (timestamp, image) of the latest snapshot, or (None, None) if there is none"""
+        snapshot = self.store.read()
+        registers = (snapshot or {}).get('state', {}).get('registers')
+        if not registers:
+            return None, None
+        timestamp, image = self.image
+        if timestamp != snapshot['timestamp']:
+            timestamp, image = snapshot['timestamp'], sofar.register_image_from_dict(registers)
+            self.image = (timestamp, image)
+            self.written = {reg: entry for reg, entry in self.written.items() if entry[0] > timestamp}
+        return timestamp, image
+
+    def read(self, start, count):
+        """Return the values of count registers from start, or a Modbus exception code"""
+        timestamp, image = self.current_image()
+        if image is None or time.time() - timestamp > self.max_age:
+            return GATEWAY_TARGET_FAILED
+        values = []
+        for reg in range(start, start + count):
+            if reg in self.written:
+                values.append(self.written[reg][1])
+            elif reg in image:
+                values.append(image[reg])
+            else:
+                return ILLEGAL_DATA_ADDRESS  # never polled, so there is no value to serve
+        return values
+
+    async def write(self, start, values):
+        """Write registers on the inverter; returns None when confirmed, else a Modbus exception code"""
+        writes = dict(zip(range(start, start + len(values)), values))
+        # Writes go out one at a time, each over its own short connection to the logger
+        async with self.write_lock:
+            error = await asyncio.to_thread(self.forward_writes, writes)
+        if error is None:
+            now = time.time()
+            self.written.update((reg, (now, value)) for reg, value in writes.items())
+        return error
+
+    def forward_writes(self, writes):
+        """Write registers under the exporter's snapshot lock; returns None when confirmed, else an exception code"""
+        open(self.write_flag_path, 'a').close()
+        os.utime(self.write_flag_path)
+        try:
+            with self.store.lock():
+                with sofar.InverterSession(self.config['inverter_ip'], self.config['inverter_port'], verbose=self.verbose) as session:
+                    results, retry_after = sofar.write_registers_limited(session, self.config, writes,
+                                                                         self.write_times_path, self.write_interval,
+                                                                         self.verbose)
+        finally:
+            os.remove(self.write_flag_path)
+
+        if results is None:
+            return SLAVE_DEVICE_BUSY  # written less than write_interval ago
+        if not session.stats['transfers']:
+            return GATEWAY_TARGET_FAILED
+        if any(results[reg] != value for reg, value in writes.items()):
+            return SLAVE_DEVICE_FAILURE
+        return None
+
+    async def answer(self, pdu):
+        """Return the response PDU to a request PDU"""
+        function = pdu[0]
+        if function in (0x03, 0x04) and len(pdu) == 5:
+            start, count = struct.unpack('>HH', pdu[1:5])
+            if not 1 <= count <= 125 or start + count > 0x10000:
+                return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+            self.stats['reads'] += 1
+            values = self.read(start, count)
+            if isinstance(values, int):
+                return bytes([function | 0x80, values])
+            return bytes([function, count * 2]) + struct.pack(f'>{count}H', *values)
+
+        if function in (0x06, 0x10) and not self.writes:
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+
+        if function == 0x06 and len(pdu) == 5:
+            start, value = struct.unpack('>HH', pdu[1:5])
+            self.stats['writes'] += 1
+            error = await self.write(start, [value])
+            return bytes([function | 0x80, error]) if error else pdu
+
+        if function == 0x10 and len(pdu) >= 6:
+            start, count, byte_count = struct.unpack('>HHB', pdu[1:6])
+            if not 1 <= count <= sofar.MAX_WRITE_REGISTERS or byte_count != count * 2 or len(pdu) != 6 + byte_count:
+                return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+            self.stats['writes'] += 1
+            error = await self.write(start, list(struct.unpack(f'>{count}H', pdu[6:])))
+            return bytes([function | 0x80, error]) if error else pdu[:5]
+
+        return bytes([function | 0x80, ILLEGAL_FUNCTION])
+
+    async def handle(self, reader, writer):
+        self.stats['clients'] += 1
+        try:
+            while True:
+                # MBAP header: transaction id, protocol id, length (unit id and PDU), unit id
+                transaction, protocol, length, unit = struct.unpack('>HHHB', await reader.readexactly(7))
+                if protocol != 0 or not 2 <= length <= 254:
+                    break
+                pdu = await reader.readexactly(length - 1)
+                try:
+                    response = await self.answer(pdu)
+                except Exception as e:
+                    # A timeout or an invalid frame from the logger, or a bug: the client gets an answer
+                    print(f"Function 0x{pdu[0]:02X} failed: {e}")
+                    response = bytes([pdu[0] | 0x80, SLAVE_DEVICE_FAILURE])
+                self.stats['exceptions'] += response[0] >= 0x80
+                writer.write(struct.pack('>HHHB', transaction, 0, len(response) + 1, unit) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(server, host, port):
+    listener = await asyncio.start_server(server.handle, host, port)
+    print(f"Serving Modbus TCP on {host}:{port}, writes {'enabled' if server.writes else 'disabled'}")
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the exporter's register snapshot over Modbus TCP.")
+    parser.add_argument("--host", help="Address to listen on (default: [ModbusServer] host or 0.0.0.0)")
+    parser.add_argument("--port", type=int, help="Port to listen on (default: [ModbusServer] port or 5020)")
+    parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("--inverter", help="Name of the [SofarInverter:<name>] section to use (default: [SofarInverter] or the only section)")
+    args = parser.parse_args()
+
+    inverters = sofar.load_inverters(config_file)
+    try:
+        config = sofar.select_inverter(inverters, args.inverter)
+    except ValueError as e:
+        parser.error(str(e))
+    server_config = load_server_config()
+    # The exporter keeps one snapshot per inverter when there are several
+    server_config['snapshot_path'] = sofar.inverter_path(server_config['snapshot_path'], config, inverters)
+    server = RegisterServer(config, server_config, args.verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        asyncio.run(serve(server, args.host or server_config['host'], args.port or server_config['port']))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(", ".join(f"{key}: {value}" for key, value in server.stats.items()))
+
+if __name__ == "__main__":
+    main()
@@ -1,449 +1,1094 @@
 #!/usr/bin/python3
 
-import sys
+import os
 import socket
-import binascii
+import sys
+
+DAEMON_SOCKET = os.path.join(os.environ.get("TMPDIR", "/tmp"), "sofar-monitor.sock")
+
+def query_daemon(socket_path, output_format, quiet=False):
+    """Return the latest output of the daemon listening on socket_path, or None if there is none"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(f"{output_format}\n".encode())
+            chunks = []
+            while chunk := sock.recv(65536):
+                chunks.append(chunk)
+    except OSError as e:
+        if not quiet:
+            print(f"No daemon listening on {socket_path}: {e}")
+        return None
+    return b"".join(chunks).decode()
+
+def daemon_client_args(argv):
+    """Return (socket path, output format) of a plain --from-daemon command line, or None for any other"""
+    options = {'--format': None, '--socket': DAEMON_SOCKET}
+    args = list(argv)
+    if "--from-daemon" not in args:
+        return None
+    args.remove("--from-daemon")
+    while args:
+        name, separator, value = args.pop(0).partition('=')
+        if name not in options:
+            return None
+        if not separator:
+            if not args:
+                return None
+            value = args.pop(0)
+        options[name] = value
+    if options['--format'] not in (None, "json", "prometheus"):
+        return None
+    return options['--socket'], options['--format'] or "text"
+
+if __name__ == "__main__":
+    # A thin client is answered before the imports below, which take most of its start-up time;
+    # any other command line, including a malformed one, is left to main()
+    client_args = daemon_client_args(sys.argv[1:])
+    if client_args is not None:
+        output = query_daemon(*client_args)
+        if output is None:
+            sys.exit(1)
+        sys.stdout.write(output)
+        sys.exit(0)
+
+import asyncio
 import re
 import libscrc
 import json
-import os
 import configparser
+import copy
 import argparse
+import bisect
+import contextlib
+import fcntl
+import functools
+import io
+import mmap
+import signal
+import socketserver
+import struct
+import threading
+import time
+from array import array
 from datetime import datetime
 
-def padhex(s):
-    return '0x' + s[2:].zfill(4)
-
-def hex_zfill(intval):
-    hexvalue = hex(intval)
-    return '0x' + str(hexvalue)[2:].zfill(4)
+def inverter_config(configParser, section):
+    """Read the settings of one [SofarInverter] or [SofarInverter:<name>] section"""
+    return {
+        'name': section.partition(':')[2] or 'inverter',
+        'inverter_ip': configParser.get(section, 'inverter_ip'),
+        'inverter_port': int(configParser.get(section, 'inverter_port')),
+        'inverter_sn': int(configParser.get(section, 'inverter_sn')),
+        'verbose': configParser.get(section, 'verbose', fallback='0'),
+        'deadline': configParser.getfloat(section, 'deadline', fallback=15),
+        'max_registers': configParser.getint(section, 'max_registers', fallback=125),
+        'frame_cost': configParser.getfloat(section, 'frame_cost', fallback=16),
+        'gap_cost': configParser.getfloat(section, 'gap_cost', fallback=1),
+        'cycle_timeout': configParser.getfloat(section, 'cycle_timeout', fallback=10),
+        'write_dialect': configParser.get(section, 'write_dialect', fallback='auto'),
+        # Relative to the directory of this script
+        'dialect_cache': os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      configParser.get(section, 'dialect_cache', fallback='write-dialects.json')),
+    }
 
 def load_config(config_path='./config.cfg'):
     """Load configuration from file"""
     configParser = configparser.RawConfigParser()
     configParser.read(config_path)
-    
-    return {
-        'inverter_ip': configParser.get('SofarInverter', 'inverter_ip'),
-        'inverter_port': int(configParser.get('SofarInverter', 'inverter_port')),
-        'inverter_sn': int(configParser.get('SofarInverter', 'inverter_sn')),
-        'verbose': configParser.get('SofarInverter', 'verbose')
-    }
+    return inverter_config(configParser, 'SofarInverter')
+
+def load_inverters(config_path='./config.cfg'):
+    """Load every [SofarInverter] and [SofarInverter:<name>] section"""
+    configParser = configparser.RawConfigParser()
+    configParser.read(config_path)
+    return [inverter_config(configParser, section) for section in configParser.sections()
+            if section == 'SofarInverter' or section.startswith('SofarInverter:')]
+
+def select_inverter(inverters, name=None):
+    """Return the inverter called name, or without a name the [SofarInverter] section or the only one
+
+    Raises ValueError when there is no such inverter or no name was given to choose among several.
+    """
+    names = ", ".join(inverter['name'] for inverter in inverters)
+    if name is None:
+        if len(inverters) == 1:
+            return inverters[0]
+        name = 'inverter'  # the plain [SofarInverter] section
+        if not any(inverter['name'] == name for inverter in inverters):
+            raise ValueError(f"several inverters are configured, choose one of: {names}" if inverters
+                             else "no [SofarInverter] section in config.cfg")
+    for inverter in inverters:
+        if inverter['name'] == name:
+            return inverter
+    raise ValueError(f"no inverter named {name}, choose one of: {names}")
+
+def inverter_path(path, inverter, inverters):
+    """Return the file kept for one inverter: path itself, or with the inverter name added when there are several"""
+    if len(inverters) == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{inverter['name']}{extension}"
+
+def build_request_frame(inverter_sn, message, sequence=0):
+    """Wrap a Modbus RTU message (without CRC) in a logger request frame"""
+    businessfield = message + struct.pack('<H', libscrc.modbus(message))
+
+    # start, length, control code, sequence number, logger serial, data field, business field,
+    # checksum placeholder and end code
+    frame = bytearray(b'\xa5' + struct.pack('<HHHI', 15 + len(businessfield), 0x4510, sequence, inverter_sn) +
+                      b'\x02' + bytes(14) + businessfield + b'\x00\x15')
+    frame[-2] = sum(frame[1:-2]) & 0xFF
+    return bytes(frame)
+
+@functools.lru_cache(maxsize=None)
+def build_read_frame(inverter_sn, start_register, num_registers):
+    """Build the request frame for reading registers; frames are cached per (serial, start, count)"""
+    return build_request_frame(inverter_sn, struct.pack('>BBHH', 0x00, 0x03, start_register, num_registers))
+
+# Most registers one write request (function 0x10) may carry
+MAX_WRITE_REGISTERS = 123
+
+def create_write_frame(inverter_sn, start_register, values, verbose=False, sequence=0):
+    """Create the frame writing consecutive values from start_register (function 0x10)"""
+    # Slave 0x00 as in the read requests; inside the logger framing the logger addresses the inverter
+    message = struct.pack(f'>BBHHB{len(values)}H', 0x00, 0x10, start_register, len(values), len(values) * 2, *values)
+    frame = build_request_frame(inverter_sn, message, sequence & 0xFFFF)
 
-def create_frame(inverter_sn, start_register, num_registers, verbose=False):
-    """Create the Modbus frame for communication"""
-    start = binascii.unhexlify('A5')
-    length = binascii.unhexlify('1700')
-    controlcode = binascii.unhexlify('1045')
-    serial = binascii.unhexlify('0000')
-    datafield = binascii.unhexlify('020000000000000000000000000000')
-
-    pos_ini = str(hex_zfill(start_register)[2:])
-    pos_fin = str(hex_zfill(num_registers)[2:])
-    businessfield = binascii.unhexlify('0003' + pos_ini + pos_fin)
-    
     if verbose:
-        print(f'Modbus request: 0103 {pos_ini} {pos_fin} {str(padhex(hex(libscrc.modbus(businessfield)))[4:6])}{str(padhex(hex(libscrc.modbus(businessfield)))[2:4])}')
-    
-    crc = binascii.unhexlify(str(padhex(hex(libscrc.modbus(businessfield)))[4:6]) + str(padhex(hex(libscrc.modbus(businessfield)))[2:4]))
-    checksum = binascii.unhexlify('00')
-    endCode = binascii.unhexlify('15')
+        print(f'Modbus write request: 0010 {start_register:04x} {len(values):04x} values {list(values)}')
+        print(f"Frame to send: {frame.hex()}")
 
-    inverter_sn2 = bytearray.fromhex(hex(inverter_sn)[8:10] + hex(inverter_sn)[6:8] + hex(inverter_sn)[4:6] + hex(inverter_sn)[2:4])
-    frame = bytearray(start + length + controlcode + serial + inverter_sn2 + datafield + businessfield + crc + checksum + endCode)
+    return frame
 
-    checksum = 0
-    frame_bytes = bytearray(frame)
-    for i in range(1, len(frame_bytes) - 2, 1):
-        checksum += frame_bytes[i] & 255
-    frame_bytes[len(frame_bytes) - 2] = int((checksum & 255))
+def create_rtu_write_frame(start_register, values, verbose=False):
+    """Create a bare Modbus RTU 0x10 frame, for loggers that pass RTU through without the logger framing"""
+    # The frame goes onto the RS485 bus as it is, where slave 0 is the broadcast address that no
+    # device answers, so it is sent to the inverter's own address 1
+    frame = bytearray(struct.pack(f'>BBHHB{len(values)}H', 0x01, 0x10, start_register, len(values), len(values) * 2, *values))
+    frame += libscrc.modbus(frame).to_bytes(2, 'little')
 
     if verbose:
-        print(f"Frame to send: {frame_bytes.hex()}")
+        print(f"Frame to send: {frame.hex()}")
 
-    return frame_bytes
+    return frame
 
-def query_registers(ip, port, frame, verbose=False):
-    """Query inverter registers"""
-    try:
-        clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        clientSocket.settimeout(15)
-        clientSocket.connect((ip, port))
-        
-        clientSocket.sendall(frame)
-        data = clientSocket.recv(1024)
-        
-        if not data:
-            print("No data received")
-            return None
+def is_rtu_write_reply(reply, frame):
+    """Whether an RTU reply acknowledges an RTU 0x10 frame: slave, function, start and count echoed"""
+    return len(reply) == 8 and reply[:6] == frame[:6] and libscrc.modbus(reply[:6]) == int.from_bytes(reply[6:], 'little')
 
-        if verbose:
-            print("Raw data received:", data.hex())
+def create_hyd_write_frame(register, value, verbose=False):
+    """Create the HYD-specific frame writing one register, as the Sofar HYD protocol describes it"""
+    frame = bytearray.fromhex('881310') + struct.pack('>HHH', register, 1, value)
+    frame += bytes.fromhex('005509C40A5A0014012C012CFFFFFFFF00000000000000000000000000000000')
+    frame += libscrc.modbus(frame[2:]).to_bytes(2, 'big')
 
-        clientSocket.close()
+    if verbose:
+        print(f"Frame to send: {frame.hex()}")
+
+    return frame
+
+def is_hyd_write_reply(reply, frame):
+    """Whether a reply acknowledges a HYD write frame: header, register, count and value echoed"""
+    return reply is not None and reply[:9] == frame[:9]
+
+def set_sequence(frame, sequence):
+    """Return a copy of a frame with another sequence number, its checksum adjusted for the change"""
+    frame = bytearray(frame)
+    old = frame[5] + frame[6]
+    frame[5] = sequence & 0xFF
+    frame[6] = (sequence >> 8) & 0xFF
+    frame[-2] = (frame[-2] - old + frame[5] + frame[6]) & 0xFF
+    return frame
+
+def get_read_frame(inverter_sn, start_register, num_registers, sequence=None):
+    """Return the cached request frame, with the sequence number patched in if one is given"""
+    frame = build_read_frame(inverter_sn, start_register, num_registers)
+    if sequence is None:
+        return frame
+    return set_sequence(frame, sequence)
+
+def create_frame(inverter_sn, start_register, num_registers, verbose=False, sequence=None):
+    """Create the Modbus frame for communication"""
+    frame = get_read_frame(inverter_sn, start_register, num_registers, sequence)
+
+    if verbose:
+        print(f'Modbus request: 0103 {start_register:04x} {num_registers:04x} {frame[32:34].hex()}')
+        print(f"Frame to send: {frame.hex()}")
+
+    return frame
+
+class FrameError(Exception):
+    """A response frame is truncated, malformed or fails its checksum or CRC"""
+
+class ChecksumError(FrameError):
+    """A response frame fails its checksum or Modbus CRC"""
+
+class ModbusError(Exception):
+    """The inverter answered with a Modbus exception"""
+
+# Response header: start, length, control code, sequence number, logger serial
+HEADER_LENGTH = 11
+# Longest frame a logger is expected to send; anything longer means the stream is out of sync
+MAX_FRAME_LENGTH = 1024
+
+def frame_length(header):
+    """Return the total length of the frame starting with this 11 byte header"""
+    if header[0] != 0xA5:
+        raise FrameError(f"bad start byte 0x{header[0]:02x}")
+    length = HEADER_LENGTH + (header[1] | header[2] << 8) + 2
+    if length > MAX_FRAME_LENGTH:
+        raise FrameError(f"implausible frame length {length}")
+    return length
+
+def is_response_to(frame, request):
+    """Whether frame is the logger's response to the request frame"""
+    # Responses carry control code 0x1510 and echo the low byte of the request sequence number
+    return frame[3:5] == b'\x10\x15' and frame[5] == request[5]
+
+def check_frame(frame):
+    """Validate the framing, checksum and CRC of a response, raising FrameError or ModbusError"""
+    if len(frame) < 32 or frame[-1] != 0x15:
+        raise FrameError("malformed frame")
+    if sum(frame[1:-2]) & 0xFF != frame[-2]:
+        raise ChecksumError("frame checksum mismatch")
+    # The Modbus CRC over the RTU message including its own CRC is zero
+    if libscrc.modbus(bytes(frame[25:-2])) != 0:
+        raise ChecksumError("Modbus CRC mismatch")
+    if frame[26] & 0x80:
+        raise ModbusError(f"Modbus exception code {frame[27]}")
+
+def check_write_response(frame, start_register, num_registers):
+    """Validate a write response frame, which echoes the start register and count"""
+    check_frame(frame)
+    if len(frame) != 35 or frame[26] != 0x10 or struct.unpack('>HH', frame[27:31]) != (start_register, num_registers):
+        raise FrameError("write response does not match the request")
+
+def check_response(frame, num_registers):
+    """Validate a read response frame, raising FrameError or ModbusError"""
+    check_frame(frame)
+    if frame[27] != num_registers * 2 or len(frame) != 32 + num_registers * 2:
+        raise FrameError(f"expected {num_registers} registers, got {frame[27] // 2}")
+
+def new_cycle_stats():
+    """Counters of one poll cycle, kept by the session and the poll loop"""
+    return {'connects': 0, 'transfers': 0, 'reconnects': 0, 'failures': 0, 'connect_failures': 0,
+            'frame_errors': 0, 'checksum_failures': 0, 'retries': 0, 'bytes': 0, 'decode_seconds': 0.0,
+            'latency': []}
+
+class InverterSession:
+    """Persistent TCP session to the data logger, shared by all register ranges of a poll cycle"""
+
+    def __init__(self, ip, port, timeout=15, verbose=False):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.verbose = verbose
+        self.sock = None
+        self.sequence = 0
+        self.reset_stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def reset_stats(self):
+        """Reset the per-cycle connect/transfer counters"""
+        self.stats = new_cycle_stats()
+
+    def time_left(self, deadline):
+        """Socket timeout for the next operation: the session timeout, cut short by the deadline"""
+        if deadline is None:
+            return self.timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("deadline exceeded")
+        return min(self.timeout, remaining)
+
+    def connect(self, deadline=None):
+        """Open a new connection to the logger, dropping any previous one"""
+        self.close()
+        if self.verbose:
+            print(f"Connecting to {self.ip}:{self.port}")
+        self.sock = socket.create_connection((self.ip, self.port), timeout=self.time_left(deadline))
+        self.stats['connects'] += 1
+
+    def close(self):
+        """Close the connection if it is open"""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def next_sequence(self):
+        """Return the sequence number for the next request frame"""
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        return self.sequence
+
+    def recv_exact(self, length, deadline=None):
+        """Read exactly length bytes, however the logger splits them into segments"""
+        data = bytearray()
+        while len(data) < length:
+            self.sock.settimeout(self.time_left(deadline))
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed by logger")
+            data += chunk
+        self.stats['bytes'] += length
         return data
 
-    except socket.error as e:
-        print(f"Socket error: {e}")
-        return None
-    except Exception as e:
-        print(f"Error: {e}")
+    def recv_response(self, request, deadline=None):
+        """Read whole frames until the response to request arrives"""
+        while True:
+            header = self.recv_exact(HEADER_LENGTH, deadline)
+            try:
+                length = frame_length(header)
+            except FrameError:
+                # Without a valid header the frame boundaries are lost; start over on a new connection
+                self.close()
+                raise
+            frame = bytes(header + self.recv_exact(length - HEADER_LENGTH, deadline))
+            if is_response_to(frame, request):
+                return frame
+            if self.verbose:
+                print("Skipping unrelated frame:", frame.hex())
+
+    def request(self, frame, retries=1, deadline=None):
+        """Send a frame and return the response, reconnecting transparently on failure
+
+        deadline (a time.monotonic() value) bounds the whole exchange, reconnects included.
+        """
+        for attempt in range(retries + 1):
+            try:
+                if self.sock is None:
+                    try:
+                        self.connect(deadline)
+                    except socket.error:
+                        self.stats['connect_failures'] += 1
+                        raise
+                self.sock.settimeout(self.time_left(deadline))
+                self.sock.sendall(frame)
+                data = self.recv_response(frame, deadline)
+                self.stats['transfers'] += 1
+
+                if self.verbose:
+                    print("Raw data received:", data.hex())
+
+                return data
+
+            except socket.error as e:
+                # The logger drops idle connections, so a failure on a reused socket
+                # is retried once on a fresh one before giving up on the range
+                self.close()
+                self.stats['failures'] += 1
+                if attempt < retries:
+                    self.stats['reconnects'] += 1
+                    if self.verbose:
+                        print(f"Socket error: {e}, reconnecting")
+                else:
+                    print(f"Socket error: {e}")
         return None
 
-def process_response(data, start_register, num_registers, verbose=False):
-    """Process response from inverter"""
+    def request_raw(self, frame, reply_length=None, deadline=None):
+        """Send a frame without the logger framing and return the reply, or None if none came
+
+        The reply is reply_length bytes, or whatever the first segment holds if that is not known.
+        The connection is closed afterwards, since the reply may be followed by bytes that would
+        desynchronise the next framed request.
+        """
+        try:
+            if self.sock is None:
+                self.connect(deadline)
+            self.sock.settimeout(self.time_left(deadline))
+            self.sock.sendall(frame)
+            if reply_length is not None:
+                data = self.recv_exact(reply_length, deadline)
+            else:
+                data = self.sock.recv(1024)
+                self.stats['bytes'] += len(data)
+            self.stats['transfers'] += bool(data)
+
+            if self.verbose:
+                print("Raw data received:", data.hex())
+
+            return bytes(data) or None
+        except socket.error as e:
+            if self.verbose:
+                print(f"Socket error: {e}")
+            return None
+        finally:
+            self.close()
+
+def query_registers(ip, port, frame, verbose=False):
+    """Query inverter registers over a one-off connection"""
+    with InverterSession(ip, port, verbose=verbose) as session:
+        return session.request(frame, retries=0)
+
+class RegisterImage:
+    """Register values indexed by integer address, with a flag for every register that has been read"""
+
+    __slots__ = ('values', 'present')
+
+    def __init__(self):
+        self.values = array('H', bytes(0x20000))
+        self.present = bytearray(0x10000)
+
+    def __contains__(self, reg):
+        return self.present[reg] != 0
+
+    def __getitem__(self, reg):
+        if not self.present[reg]:
+            raise KeyError(reg)
+        return self.values[reg]
+
+    def __len__(self):
+        return self.present.count(1)
+
+    def update(self, start_register, words):
+        """Store consecutive register values starting at start_register"""
+        end = start_register + len(words)
+        self.values[start_register:end] = words
+        self.present[start_register:end] = b'\x01' * len(words)
+
+def process_response(data, start_register, num_registers, verbose=False, image=None):
+    """Process response from inverter into a register image"""
+    if image is None:
+        image = RegisterImage()
     if not data:
-        return {}
-    
-    response = str(''.join(hex(ord(chr(x)))[2:].zfill(2) for x in bytearray(data)))
-    register_values = {}
-    
-    for i in range(num_registers + 1):
-        p1 = 56 + (i * 4)
-        p2 = 60 + (i * 4)
-        responsereg = response[p1:p2]
-        hexpos = str("0x") + str(hex(i+start_register)[2:].zfill(4)).upper()
-        
-        register_values[hexpos] = responsereg
-        
-        if verbose:
-            print(f"Register: {hexpos} , value: hex:{str(responsereg)}")
-    
-    return register_values
+        return image
+
+    # Register data starts after the 25 byte header and the Modbus address, function and byte count;
+    # never read past the byte count, which would pick up the Modbus CRC as an extra register
+    count = min(num_registers, data[27] // 2, (len(data) - 28) // 2) if len(data) > 28 else 0
+    words = array('H')
+    words.frombytes(memoryview(data)[28:28 + count * 2])
+    if sys.byteorder == 'little':
+        words.byteswap()
+    image.update(start_register, words)
+
+    if verbose:
+        for i, value in enumerate(words):
+            print(f"Register: 0x{start_register + i:04X} , value: hex:{value:04x}")
+
+    return image
+
+def register_blocks(image):
+    """Yield (start, values) for every run of consecutive registers present in the image"""
+    present = image.present
+    start = present.find(1)
+    while start != -1:
+        end = present.find(0, start)
+        if end == -1:
+            end = len(present)
+        yield start, image.values[start:end]
+        start = present.find(1, end)
+
+def register_image_to_dict(image):
+    """Return the image as {"0x0404": [value, ...], ...}, one entry per block of consecutive registers"""
+    return {f"0x{start:04X}": values.tolist() for start, values in register_blocks(image)}
+
+def register_image_from_dict(registers, image=None):
+    """Build (or update) a register image from register_image_to_dict() output"""
+    if image is None:
+        image = RegisterImage()
+    for start, values in registers.items():
+        image.update(int(start, 16), array('H', values))
+    return image
+
+def load_register_image(path):
+    """Load a register image saved as {"registers": {"0x0404": [value, ...], ...}}"""
+    with open(path) as f:
+        saved = json.load(f)
+    return register_image_from_dict(saved['registers'])
+
+def save_register_image(image, path, description=""):
+    """Save a register image as consecutive register blocks"""
+    # One block per line keeps saved images readable and diffable
+    blocks = ',\n'.join(f'    "0x{start:04X}": {json.dumps(values.tolist())}' for start, values in register_blocks(image))
+    with open(path, 'w') as f:
+        f.write(f'{{\n  "description": {json.dumps(description)},\n  "registers": {{\n{blocks}\n  }}\n}}\n')
+
+def record_response(capture, start_register, num_registers, response):
+    """Append a validated response frame to a capture file, one JSON object per line"""
+    capture.write(json.dumps({'time': time.time(), 'start': start_register, 'count': num_registers,
+                              'response': response.hex()}) + "\n")
+
+# Archive of raw register images: a header, then records of a fixed header and a body. A keyframe
+# record holds every known register, a delta record only those that changed since the previous record.
+# The .idx file next to the archive lists (timestamp, offset) of every keyframe.
+ARCHIVE_MAGIC = b'SOFARRA1'
+ARCHIVE_RECORD = struct.Struct('<IdBH')  # body length, timestamp, kind, number of blocks or changes
+ARCHIVE_INDEX = struct.Struct('<dQ')     # keyframe timestamp, offset
+ARCHIVE_KEYFRAME, ARCHIVE_DELTA = 0, 1
+
+def little_endian_words(words):
+    """Return the bytes of a uint16 array in little-endian order"""
+    if sys.byteorder == 'big':
+        words = array('H', words)
+        words.byteswap()
+    return words.tobytes()
+
+def words_from_bytes(data):
+    """Return a uint16 array from little-endian bytes"""
+    words = array('H')
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+def apply_archive_record(image, kind, count, body):
+    """Apply a keyframe or delta record body to a register image"""
+    if kind == ARCHIVE_KEYFRAME:
+        pos = 0
+        for _ in range(count):
+            start, length = struct.unpack_from('<HH', body, pos)
+            image.update(start, words_from_bytes(body[pos + 4:pos + 4 + length * 2]))
+            pos += 4 + length * 2
+    else:
+        pairs = words_from_bytes(body)
+        values, present = image.values, image.present
+        for i in range(0, len(pairs), 2):
+            values[pairs[i]] = pairs[i + 1]
+            present[pairs[i]] = 1
+
+def archive_records(data, pos):
+    """Yield (offset, end, timestamp, kind, count, body) for every complete record from pos on"""
+    while pos + ARCHIVE_RECORD.size <= len(data):
+        length, timestamp, kind, count = ARCHIVE_RECORD.unpack_from(data, pos)
+        end = pos + ARCHIVE_RECORD.size + length
+        if end > len(data):
+            break  # the last record was cut short
+        yield pos, end, timestamp, kind, count, data[pos + ARCHIVE_RECORD.size:end]
+        pos = end
+
+def read_archive_index(path):
+    """Return the [(timestamp, offset), ...] keyframes of an archive"""
+    try:
+        with open(path + '.idx', 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return [ARCHIVE_INDEX.unpack_from(data, pos) for pos in range(0, len(data) - ARCHIVE_INDEX.size + 1, ARCHIVE_INDEX.size)]
+
+class RegisterArchive:
+    """Append-only archive of timestamped register images, delta-encoded between keyframes
+
+    Registers missing from an appended image keep their previous value. Several processes may append
+    to one archive: loading and appending hold an exclusive lock on the file, so they take turns.
+    """
+
+    def __init__(self, path, keyframe_interval=3600):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, 'a+b')
+        self.index = open(path + '.idx', 'a+b')
+        with self.lock():
+            self.load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the lock that makes the processes appending to the archive take turns"""
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def load(self):
+        """Rebuild the current register state from the last keyframe, dropping a cut-short last record
+
+        Only called while holding the lock, so a record another process is writing is never cut.
+        """
+        self.state = RegisterImage()
+        self.since_keyframe = None  # records since the last keyframe; None forces a keyframe
+        self.end = len(ARCHIVE_MAGIC)
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            self.file.write(ARCHIVE_MAGIC)
+            self.file.flush()
+            return
+
+        self.file.seek(0)
+        if self.file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError(f"{self.path} is not a register archive")
+
+        # Replay from the last keyframe that was written completely (from the start without an index),
+        # adding any keyframe the index missed
+        keyframes = [entry for entry in read_archive_index(self.path) if entry[1] < size]
+        while True:
+            position = keyframes[-1][1] if keyframes else len(ARCHIVE_MAGIC)
+            self.file.seek(position)
+            found = []
+            for offset, end, timestamp, kind, count, body in archive_records(self.file.read(), 0):
+                if kind == ARCHIVE_KEYFRAME:
+                    self.state = RegisterImage()
+                    self.since_keyframe = 0
+                    found.append((timestamp, position + offset))
+                elif self.since_keyframe is not None:
+                    self.since_keyframe += 1
+                apply_archive_record(self.state, kind, count, body)
+                self.end = position + end
+            if not keyframes or self.end > position:
+                break
+            keyframes.pop()
+        keyframes = sorted(set(keyframes + found), key=lambda entry: entry[1])
+
+        # A crash may leave half a record or index entry behind
+        if self.end < size:
+            self.file.truncate(self.end)
+        self.index.truncate(0)
+        self.index.write(b''.join(ARCHIVE_INDEX.pack(*entry) for entry in keyframes))
+        self.index.flush()
+
+    def append(self, timestamp, image):
+        """Append a register image taken at timestamp"""
+        with self.lock():
+            if os.fstat(self.file.fileno()).st_size != self.end:
+                self.load()  # another process has appended since
+
+            if self.since_keyframe is None or self.since_keyframe + 1 >= self.keyframe_interval:
+                for start, words in register_blocks(image):
+                    self.state.update(start, words)
+                blocks = list(register_blocks(self.state))
+                body = b''.join(struct.pack('<HH', start, len(words)) + little_endian_words(words) for start, words in blocks)
+                kind, count = ARCHIVE_KEYFRAME, len(blocks)
+            else:
+                values, present = self.state.values, self.state.present
+                changes = array('H')
+                for start, words in register_blocks(image):
+                    for reg, value in enumerate(words, start):
+                        if not present[reg] or values[reg] != value:
+                            changes.append(reg)
+                            changes.append(value)
+                    self.state.update(start, words)
+                body = little_endian_words(changes)
+                kind, count = ARCHIVE_DELTA, len(changes) // 2
+
+            offset = self.end
+            self.file.write(ARCHIVE_RECORD.pack(len(body), timestamp, kind, count) + body)
+            self.file.flush()
+            self.end += ARCHIVE_RECORD.size + len(body)
+            if kind == ARCHIVE_KEYFRAME:
+                self.index.write(ARCHIVE_INDEX.pack(timestamp, offset))
+                self.index.flush()
+                self.since_keyframe = 0
+            else:
+                self.since_keyframe += 1
+
+def read_archive(path, start=None, end=None):
+    """Yield (timestamp, image) for every archived image from start to end (time.time() values)
+
+    The file is memory-mapped and decoding starts at the last keyframe before start, so only the
+    requested part of the archive is read. The same image object is updated and yielded every time.
+    """
+    keyframes = read_archive_index(path)
+    position = len(ARCHIVE_MAGIC)
+    if start is not None and keyframes:
+        i = bisect.bisect_right([timestamp for timestamp, _ in keyframes], start)
+        if i > 0:
+            position = keyframes[i - 1][1]
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= position:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            image = RegisterImage()
+            for _, _, timestamp, kind, count, body in archive_records(data, position):
+                if end is not None and timestamp > end:
+                    break
+                apply_archive_record(image, kind, count, body)
+                if start is None or timestamp >= start:
+                    yield timestamp, image
 
 def get_register(values, reg, scale=1.0, signed=False):
     """Get scaled register value"""
-    try:
-        if reg not in values:
-            return None
-        val = int(values[reg], 16)
-        if signed and val > 32767:
-            val -= 65536
-        return val * scale
-    except:
+    if reg not in values:
         return None
+    val = values[reg]
+    if signed and val > 32767:
+        val -= 65536
+    return val * scale
 
 def get_32bit_register(values, high_reg, low_reg, scale=1.0):
     """Get 32-bit register value"""
-    try:
-        if high_reg not in values or low_reg not in values:
-            return None
-        high_val = int(values[high_reg], 16)
-        low_val = int(values[low_reg], 16)
-        val = (high_val << 16) + low_val
-        return val * scale
-    except:
+    if high_reg not in values or low_reg not in values:
         return None
+    val = (values[high_reg] << 16) + values[low_reg]
+    return val * scale
+
+# Fault register -> {bit value: description}
+FAULT_DEFINITIONS = {
+    0x0405: {
+        0: "No error",
+        1: "ID01 Grid Over Voltage Protection",
+        2: "ID02 Grid Under Voltage Protection",
+        4: "ID03 Grid Over Frequency Protection",
+        8: "ID04 Grid Under Frequency Protection",
+        16: "ID05 Leakage current fault",
+        32: "ID06 High penetration error",
+        64: "ID07 Low penetration error",
+        128: "ID08 Islanding error",
+        256: "ID09 Grid voltage transient overvoltage 1",
+        512: "ID10 Grid voltage transient overvoltage 2",
+        1024: "ID11 Grid line voltage error",
+        2048: "ID12 Inverter voltage error",
+        4096: "ID13 Anti-backflow overload",
+    },
+    0x0406: {
+        0: "No error",
+        1: "ID17 Grid current sampling error",
+        2: "ID18 Grid current DC component sampling error (AC side)",
+        4: "ID19 Grid voltage sampling error (DC side)",
+        8: "ID20 Grid voltage sampling error (AC side)",
+        16: "ID21 Leakage current sampling error (DC side)",
+        32: "ID22 Leakage current sampling error (AC side)",
+        64: "ID23 Load voltage DC component sampling error",
+        128: "ID24 DC input current sampling error",
+        256: "ID25 DC component sampling error of grid current",
+        512: "ID26 DC input branch current sampling error",
+        4096: "ID29 Leakage current consistency error",
+        8192: "ID30 Grid voltage consistency error",
+        16384: "ID31 DCI consistency error",
+    },
+    0x0407: {
+        0: "No error",
+        1: "ID32 Over temperature fault",
+        2: "ID33 Fan failure",
+        4: "ID34 Communication error with modules",
+        8: "ID35 EEPROM read/write error",
+        16: "ID36 DSP error",
+        32: "ID37 Flash memory error",
+        64: "ID38 RTC failure",
+        128: "ID39 Calibration parameter error",
+        256: "ID40 Initialization failure",
+        512: "ID41 Internal fault",
+    },
+    0x0408: {
+        0: "No error",
+        1: "ID42 Overload fault",
+        2: "ID43 Short circuit protection",
+        4: "ID44 Voltage harmonics fault",
+        8: "ID45 Grid impedance too high",
+        16: "ID46 Current imbalance fault",
+        32: "ID47 DC bus overvoltage",
+        64: "ID48 DC bus undervoltage",
+        128: "ID49 Phase loss protection",
+        256: "ID50 Phase sequence error",
+    },
+    0x0409: {
+        0: "No error",
+        1: "ID51 Grid phase current unbalance fault",
+        2: "ID52 DC link voltage fault",
+        4: "ID53 AC overcurrent fault",
+        8: "ID54 Power module fault",
+        16: "ID55 Internal communication fault",
+        32: "ID56 Protection circuit fault",
+        64: "ID57 DC input voltage fault",
+        128: "ID58 PV overvoltage fault",
+    },
+    0x0410: {
+        0: "No error",
+        1: "ID59 Ground fault detection error",
+        2: "ID60 Insulation resistance fault",
+        4: "ID61 PV input overcurrent",
+        8: "ID62 Inverter startup failure",
+        16: "ID63 Active anti-islanding protection fault",
+        32: "ID64 Reactive power control fault",
+    },
+    0x0411: {
+        0: "No error",
+        1: "ID65 System self-test fault",
+        2: "ID66 Power factor fault",
+        4: "ID67 Inverter hardware error",
+        8: "ID68 Battery communication fault",
+        16: "ID69 Battery overcharge protection",
+        32: "ID70 Battery undervoltage protection",
+    },
+    0x0412: {
+        0: "No error",
+        1: "ID71 Grid synchronization timeout",
+        2: "ID72 AC output fault",
+        4: "ID73 Battery overcurrent protection",
+        8: "ID74 Battery temperature fault",
+        16: "ID75 Power module overtemperature",
+    },
+    0x0413: {
+        0: "No error",
+        1: "ID76 Cooling system fault",
+        2: "ID77 DC bus fault",
+        4: "ID78 Grid phase voltage imbalance",
+        8: "ID79 Battery charge/discharge fault",
+        16: "ID80 PV input configuration error",
+    },
+    0x0414: {
+        0: "No error",
+        1: "ID81 Output overvoltage",
+        2: "ID82 Output undervoltage",
+        4: "ID83 Frequency deviation fault",
+        8: "ID84 Overload timeout fault",
+    },
+    0x0415: {
+        0: "No error",
+        1: "ID85 Communication mismatch",
+        2: "ID86 Isolation resistance low",
+        4: "ID87 Hardware incompatibility fault",
+        8: "ID88 Voltage sag detection error",
+    },
+    0x0416: {
+        0: "No error",
+        1: "ID89 Overfrequency transient fault",
+        2: "ID90 Undervoltage transient fault",
+        4: "ID91 Voltage rise timeout fault",
+    },
+}
+
+def compile_fault_bits(definitions=FAULT_DEFINITIONS):
+    """Turn the fault definitions into (register, 16 entries indexed by bit position) pairs"""
+    fault_bits = []
+    for reg, fault_map in definitions.items():
+        bits = [None] * 16
+        for code, description in fault_map.items():
+            if code:
+                fault_id = int(description[2:description.index(' ')])
+                bits[code.bit_length() - 1] = {"code": code, "id": fault_id, "description": description}
+        fault_bits.append((reg, tuple(bits)))
+    return tuple(fault_bits)
+
+FAULT_BITS = compile_fault_bits()
+
+# Shared result for the usual case of no active faults
+NO_FAULTS = ()
 
 def interpret_fault_codes(values):
-    """Capture fault codes as both decimal integers and descriptions."""
-    faults = []
-    fault_definitions = {
-        '0x0405': {
-            0: "No error",
-            1: "ID01 Grid Over Voltage Protection",
-            2: "ID02 Grid Under Voltage Protection",
-            4: "ID03 Grid Over Frequency Protection",
-            8: "ID04 Grid Under Frequency Protection",
-            16: "ID05 Leakage current fault",
-            32: "ID06 High penetration error",
-            64: "ID07 Low penetration error",
-            128: "ID08 Islanding error",
-            256: "ID09 Grid voltage transient overvoltage 1",
-            512: "ID10 Grid voltage transient overvoltage 2",
-            1024: "ID11 Grid line voltage error",
-            2048: "ID12 Inverter voltage error",
-            4096: "ID13 Anti-backflow overload",
-        },
-        '0x0406': {
-            0: "No error",
-            1: "ID17 Grid current sampling error",
-            2: "ID18 Grid current DC component sampling error (AC side)",
-            4: "ID19 Grid voltage sampling error (DC side)",
-            8: "ID20 Grid voltage sampling error (AC side)",
-            16: "ID21 Leakage current sampling error (DC side)",
-            32: "ID22 Leakage current sampling error (AC side)",
-            64: "ID23 Load voltage DC component sampling error",
-            128: "ID24 DC input current sampling error",
-            256: "ID25 DC component sampling error of grid current",
-            512: "ID26 DC input branch current sampling error",
-            4096: "ID29 Leakage current consistency error",
-            8192: "ID30 Grid voltage consistency error",
-            16384: "ID31 DCI consistency error",
-        },
-        '0x0407': {
-            0: "No error",
-            1: "ID32 Over temperature fault",
-            2: "ID33 Fan failure",
-            4: "ID34 Communication error with modules",
-            8: "ID35 EEPROM read/write error",
-            16: "ID36 DSP error",
-            32: "ID37 Flash memory error",
-            64: "ID38 RTC failure",
-            128: "ID39 Calibration parameter error",
-            256: "ID40 Initialization failure",
-            512: "ID41 Internal fault",
-        },
-        '0x0408': {
-            0: "No error",
-            1: "ID42 Overload fault",
-            2: "ID43 Short circuit protection",
-            4: "ID44 Voltage harmonics fault",
-            8: "ID45 Grid impedance too high",
-            16: "ID46 Current imbalance fault",
-            32: "ID47 DC bus overvoltage",
-            64: "ID48 DC bus undervoltage",
-            128: "ID49 Phase loss protection",
-            256: "ID50 Phase sequence error",
-        },
-        '0x0409': {
-            0: "No error",
-            1: "ID51 Grid phase current unbalance fault",
-            2: "ID52 DC link voltage fault",
-            4: "ID53 AC overcurrent fault",
-            8: "ID54 Power module fault",
-            16: "ID55 Internal communication fault",
-            32: "ID56 Protection circuit fault",
-            64: "ID57 DC input voltage fault",
-            128: "ID58 PV overvoltage fault",
-        },
-        '0x0410': {
-            0: "No error",
-            1: "ID59 Ground fault detection error",
-            2: "ID60 Insulation resistance fault",
-            4: "ID61 PV input overcurrent",
-            8: "ID62 Inverter startup failure",
-            16: "ID63 Active anti-islanding protection fault",
-            32: "ID64 Reactive power control fault",
-        },
-        '0x0411': {
-            0: "No error",
-            1: "ID65 System self-test fault",
-            2: "ID66 Power factor fault",
-            4: "ID67 Inverter hardware error",
-            8: "ID68 Battery communication fault",
-            16: "ID69 Battery overcharge protection",
-            32: "ID70 Battery undervoltage protection",
-        },
-        '0x0412': {
-            0: "No error",
-            1: "ID71 Grid synchronization timeout",
-            2: "ID72 AC output fault",
-            4: "ID73 Battery overcurrent protection",
-            8: "ID74 Battery temperature fault",
-            16: "ID75 Power module overtemperature",
-        },
-        '0x0413': {
-            0: "No error",
-            1: "ID76 Cooling system fault",
-            2: "ID77 DC bus fault",
-            4: "ID78 Grid phase voltage imbalance",
-            8: "ID79 Battery charge/discharge fault",
-            16: "ID80 PV input configuration error",
-        },
-        '0x0414': {
-            0: "No error",
-            1: "ID81 Output overvoltage",
-            2: "ID82 Output undervoltage",
-            4: "ID83 Frequency deviation fault",
-            8: "ID84 Overload timeout fault",
-        },
-        '0x0415': {
-            0: "No error",
-            1: "ID85 Communication mismatch",
-            2: "ID86 Isolation resistance low",
-            4: "ID87 Hardware incompatibility fault",
-            8: "ID88 Voltage sag detection error",
-        },
-        '0x0416': {
-            0: "No error",
-            1: "ID89 Overfrequency transient fault",
-            2: "ID90 Undervoltage transient fault",
-            4: "ID91 Voltage rise timeout fault",
-        },
-    }
-    
-    for reg, fault_map in fault_definitions.items():
-        if reg in values:
-            fault_value = int(values[reg], 16)
-            for code, description in fault_map.items():
-                if code != 0 and (fault_value & code):
-                    faults.append({"code": code, "description": description})
-                    
+    """Capture fault codes as decimal integers, fault IDs and descriptions.
+
+    Returns NO_FAULTS without allocating anything when every fault register is zero or was not
+    read; the fault entries are shared and must not be modified.
+    """
+    words, present = values.values, values.present
+    faults = NO_FAULTS
+    for reg, bits in FAULT_BITS:
+        word = words[reg]
+        # A register that was not read holds no faults, whatever its slot in the image contains
+        if not word or not present[reg]:
+            continue
+        if faults is NO_FAULTS:
+            faults = []
+        # Visit the set bits only, lowest first
+        while word:
+            low_bit = word & -word
+            fault = bits[low_bit.bit_length() - 1]
+            if fault is not None:
+                faults.append(fault)
+            word ^= low_bit
+
     return faults
 
-def get_battery_metrics(values):
-    """Get metrics for both batteries"""
-    batteries = {}
-    
+STATUS_MAP = {
+    0: 'Waiting', 1: 'Detecting', 2: 'GridConnected', 3: 'EPS',
+    4: 'Recoverable fault', 5: 'Permanent fault', 6: 'Upgrading',
+    7: 'Self-charging', 8: 'StaticVarGen', 9: 'PotentialInducedDegradationRecovery'
+}
+
+def timestamp(values):
+    return datetime.now().isoformat()
+
+# Output layout shared by the JSON, text and Prometheus formats, in output order.
+# Each entry is (path, source, scale, signed, precision, convert): source is a register address,
+# a (high, low) address pair for 32-bit values or a function of the register image; precision
+# None means the scaled value is not rounded and convert is applied to the scaled value.
+REGISTER_MAP = [
+    ('timestamp', timestamp),
+    ('status.state', 0x0404, 1, False, None, STATUS_MAP.get),
+    ('status.state_decimal', 0x0404, 1, False, None, int),
+    ('status.generation_time_minutes', 0x0426, 1, False, None, int),
+    ('status.ambient_temp', 0x0418, 1, True, 1),
+    ('status.module_temp', 0x0420, 1, True, 1),
+    ('status.heatsink_temp', 0x041A, 1, True, 1),
+    ('faults', interpret_fault_codes),
+    ('pv1.voltage', 0x0584, 0.1, False, 1),
+    ('pv1.current', 0x0585, 0.01, False, 2),
+    ('pv1.power', 0x0586, 0.01, False, 2),  # kW
+    ('pv2.voltage', 0x0587, 0.1, False, 1),
+    ('pv2.current', 0x0588, 0.01, False, 2),
+    ('pv2.power', 0x0589, 0.01, False, 2),  # kW
+    ('grid.frequency', 0x0484, 0.01, False, 2),
+    ('grid.voltage.phase_r', 0x048D, 0.1, False, 1),
+    ('grid.voltage.phase_s', 0x0498, 0.1, False, 1),
+    ('grid.voltage.phase_t', 0x04A3, 0.1, False, 1),
+    ('grid.generation.total.active', 0x0485, 0.01, True, 2),  # kW
+    ('grid.generation.total.reactive', 0x0486, 0.01, True, 2),
+    ('grid.generation.total.apparent', 0x0487, 0.01, True, 2),
+    ('grid.generation.phase_r.current', 0x048E, 0.01, False, 2),
+    ('grid.generation.phase_r.active_power', 0x048F, 0.01, True, 2),  # kW
+    ('grid.generation.phase_r.reactive_power', 0x0490, 0.01, True, 2),
+    ('grid.generation.phase_r.power_factor', 0x0491, 0.001, True, 3),
+    ('grid.generation.phase_s.current', 0x0499, 0.01, False, 2),
+    ('grid.generation.phase_s.active_power', 0x049A, 0.01, True, 2),  # kW
+    ('grid.generation.phase_s.reactive_power', 0x049B, 0.01, True, 2),
+    ('grid.generation.phase_s.power_factor', 0x049C, 0.001, True, 3),
+    ('grid.generation.phase_t.current', 0x04A4, 0.01, False, 2),
+    ('grid.generation.phase_t.active_power', 0x04A5, 0.01, True, 2),  # kW
+    ('grid.generation.phase_t.reactive_power', 0x04A6, 0.01, True, 2),
+    ('grid.generation.phase_t.power_factor', 0x04A7, 0.001, True, 3),
+    ('grid.pcc.total.active', 0x0488, 0.01, True, 2),  # kW
+    ('grid.pcc.total.reactive', 0x0489, 0.01, True, 2),
+    ('grid.pcc.total.apparent', 0x048A, 0.01, True, 2),
+    ('grid.pcc.total.sys_load', 0x04AF, 0.01, True, 2),
+    ('grid.pcc.phase_r.current', 0x0492, 0.01, False, 2),
+    ('grid.pcc.phase_r.active_power', 0x0493, 0.01, True, 2),  # kW
+    ('grid.pcc.phase_r.reactive_power', 0x0494, 0.01, True, 2),
+    ('grid.pcc.phase_r.power_factor', 0x0495, 0.001, True, 3),
+    ('grid.pcc.phase_s.current', 0x049D, 0.01, False, 2),
+    ('grid.pcc.phase_s.active_power', 0x049E, 0.01, True, 2),  # kW
+    ('grid.pcc.phase_s.reactive_power', 0x049F, 0.01, True, 2),
+    ('grid.pcc.phase_s.power_factor', 0x04A0, 0.001, True, 3),
+    ('grid.pcc.phase_t.current', 0x04A8, 0.01, False, 2),
+    ('grid.pcc.phase_t.active_power', 0x04A9, 0.01, True, 2),  # kW
+    ('grid.pcc.phase_t.reactive_power', 0x04AA, 0.01, True, 2),
+    ('grid.pcc.phase_t.power_factor', 0x04AB, 0.001, True, 3),
+    ('off_grid.frequency', 0x0507, 0.01, False, 2),
+    ('off_grid.total.active', 0x0504, 0.01, True, 2),  # kW
+    ('off_grid.total.reactive', 0x0505, 0.01, True, 2),
+    ('off_grid.total.apparent', 0x0506, 0.01, True, 2),
+    ('off_grid.phase_r.voltage', 0x050A, 0.1, False, 1),
+    ('off_grid.phase_r.current', 0x050B, 0.01, False, 2),
+    ('off_grid.phase_r.active_power', 0x050C, 0.01, True, 2),  # kW
+    ('off_grid.phase_r.reactive_power', 0x050D, 0.01, True, 2),
+    ('off_grid.phase_r.apparent_power', 0x050E, 0.01, True, 2),
+    ('off_grid.phase_s.voltage', 0x0512, 0.1, False, 1),
+    ('off_grid.phase_s.current', 0x0513, 0.01, False, 2),
+    ('off_grid.phase_s.active_power', 0x0514, 0.01, True, 2),  # kW
+    ('off_grid.phase_s.reactive_power', 0x0515, 0.01, True, 2),
+    ('off_grid.phase_s.apparent_power', 0x0516, 0.01, True, 2),
+    ('off_grid.phase_t.voltage', 0x051A, 0.1, False, 1),
+    ('off_grid.phase_t.current', 0x051B, 0.01, False, 2),
+    ('off_grid.phase_t.active_power', 0x051C, 0.01, True, 2),  # kW
+    ('off_grid.phase_t.reactive_power', 0x051D, 0.01, True, 2),
+    ('off_grid.phase_t.apparent_power', 0x051E, 0.01, True, 2),
+    # kWh values
+    ('generation.daily', (0x0684, 0x0685), 0.01, False, 2),
+    ('generation.total', (0x0686, 0x0687), 0.1, False, 1),
+    ('generation.load_daily', (0x0688, 0x0689), 0.01, False, 2),
+    ('generation.load_total', (0x068A, 0x068B), 0.1, False, 1),
+    ('generation.bought_daily', (0x068C, 0x068D), 0.01, False, 2),
+    ('generation.bought_total', (0x068E, 0x068F), 0.1, False, 1),
+    ('generation.sold_daily', (0x0690, 0x0691), 0.01, False, 2),
+    ('generation.sold_total', (0x0692, 0x0693), 0.1, False, 1),
+    ('generation.battery_charge_daily', (0x0694, 0x0695), 0.01, False, 2),
+    ('generation.battery_charge_total', (0x0696, 0x0697), 0.1, False, 1),
+    ('generation.battery_discharge_daily', (0x0698, 0x0699), 0.01, False, 2),
+    ('generation.battery_discharge_total', (0x069A, 0x069B), 0.1, False, 1),
+]
+
+def battery_register_map(bat_num):
+    """Register map entries of one battery pack"""
     # Battery 1: 0x0604 - 0x060A
     # Battery 2: 0x060B - 0x0611
-    for bat_num in range(2):
-        base_addr = 0x0604 + (bat_num * 7)
-        
-        battery_data = {
-            'voltage': get_register(values, f'0x{base_addr:04X}', 0.1),
-            'current': get_register(values, f'0x{base_addr+1:04X}', 0.01, True),
-            'power': get_register(values, f'0x{base_addr+2:04X}', 10, True),
-            'temperature': get_register(values, f'0x{base_addr+3:04X}', 1, True),
-            'soc': get_register(values, f'0x{base_addr+4:04X}', 1),
-            'soh': get_register(values, f'0x{base_addr+5:04X}', 1),
-            'cycles': get_register(values, f'0x{base_addr+6:04X}', 1),
-        }
-        
-        if any(v is not None for v in battery_data.values()):
-            batteries[f'battery_{bat_num + 1}'] = battery_data
-    
-    # Battery settings
-    batteries['settings'] = {
-        'dod': get_register(values, '0x104D', 1),
-        'eod': get_register(values, '0x104E', 1),
-        'eps_buffer': get_register(values, '0x1052', 1)
-    }
-    
-    return batteries
+    base_addr = 0x0604 + (bat_num * 7)
+    prefix = f'batteries.battery_{bat_num + 1}'
+    return [
+        (f'{prefix}.voltage', base_addr, 0.1, False, None),
+        (f'{prefix}.current', base_addr + 1, 0.01, True, None),
+        (f'{prefix}.power', base_addr + 2, 10, True, None),
+        (f'{prefix}.temperature', base_addr + 3, 1, True, None),
+        (f'{prefix}.soc', base_addr + 4, 1, False, None),
+        (f'{prefix}.soh', base_addr + 5, 1, False, None),
+        (f'{prefix}.cycles', base_addr + 6, 1, False, None),
+    ]
+
+REGISTER_MAP += battery_register_map(0) + battery_register_map(1) + [
+    ('batteries.settings.dod', 0x104D, 1, False, None),
+    ('batteries.settings.eod', 0x104E, 1, False, None),
+    ('batteries.settings.eps_buffer', 0x1052, 1, False, None),
+]
+
+# Sections left out of the output when none of their values could be read
+OPTIONAL_SECTIONS = {'batteries.battery_1', 'batteries.battery_2'}
+
+def compile_register_map(register_map=REGISTER_MAP, optional_sections=OPTIONAL_SECTIONS):
+    """Compile the register map into one function that builds the whole snapshot in a single pass
+
+    The generated function reads the register image arrays directly, so decoding costs one
+    expression per value instead of a lookup, a call and a try/except.
+    """
+    namespace = {'has_value': lambda section: any(v is not None for v in section.values())}
+    tree = {}
+    for entry in register_map:
+        node = tree
+        *parents, key = entry[0].split('.')
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[key] = entry
+
+    def value_expr(entry):
+        path, source = entry[0], entry[1]
+        if callable(source):
+            name = f'source_{len(namespace)}'
+            namespace[name] = source
+            return f'{name}(image)'
+
+        scale, signed, precision = entry[2:5]
+        if isinstance(source, tuple):
+            high, low = source
+            raw, present = f'((values[{high}] << 16) + values[{low}])', f'present[{high}] and present[{low}]'
+        elif signed:
+            raw, present = f'((values[{source}] ^ 0x8000) - 0x8000)', f'present[{source}]'
+        else:
+            raw, present = f'values[{source}]', f'present[{source}]'
+
+        expr = f'{raw} * {scale!r}'
+        if precision is not None:
+            expr = f'round({expr}, {precision})'
+        if len(entry) > 5:
+            name = f'convert_{len(namespace)}'
+            namespace[name] = entry[5]
+            expr = f'{name}({expr})'
+        return f'({expr} if {present} else None)'
+
+    statements = []
+
+    def dict_expr(node, path):
+        items = []
+        for key, child in node.items():
+            child_path = f'{path}.{key}' if path else key
+            if not isinstance(child, dict):
+                items.append(f'{key!r}: {value_expr(child)}')
+            elif child_path in optional_sections:
+                name = f'section_{len(statements)}'
+                statements.append(f'    {name} = {dict_expr(child, child_path)}')
+                items.append(f'**({{{key!r}: {name}}} if has_value({name}) else {{}})')
+            else:
+                items.append(f'{key!r}: {dict_expr(child, child_path)}')
+        return '{' + ', '.join(items) + '}'
+
+    body = dict_expr(tree, '')
+    source = '\n'.join(['def decode(image):',
+                        '    values, present = image.values, image.present',
+                        *statements,
+                        f'    return {body}'])
+    exec(compile(source, '<register map>', 'exec'), namespace)
+    return namespace['decode']
+
+decode_register_map = compile_register_map()
 
 def format_data(values):
     """Format all data into structured dictionary with fault codes as both decimals and descriptions."""
-    status_map = {
-        0: 'Waiting', 1: 'Detecting', 2: 'GridConnected', 3: 'EPS',
-        4: 'Recoverable fault', 5: 'Permanent fault', 6: 'Upgrading',
-        7: 'Self-charging', 8: 'StaticVarGen', 9: 'PotentialInducedDegradationRecovery'
-    }
-
-    def format_value(value, precision):
-        return round(value, precision) if value is not None else None
-
-    status_val = get_register(values, '0x0404')
-    fault_descriptions = interpret_fault_codes(values) or []  # Ensure it's a list, even if empty
-
-    return {
-        'timestamp': datetime.now().isoformat(),
-        'status': {
-            'state': status_map.get(status_val) if status_val is not None else None,
-            'state_decimal': int(status_val) if status_val is not None else None,
-            'generation_time_minutes': int(get_register(values, '0x0426')),
-            'ambient_temp': format_value(get_register(values, '0x0418', 1, True), 1),  # Added True for signed
-            'module_temp': format_value(get_register(values, '0x0420', 1, True), 1),   # Added True for signed
-            'heatsink_temp': format_value(get_register(values, '0x041A', 1, True), 1)  # Added True for signed
-        },
-        'faults': [fault['code'] for fault in fault_descriptions],  # List of just fault codes
-        'pv1': {
-            'voltage': format_value(get_register(values, '0x0584', 0.1), 1),
-            'current': format_value(get_register(values, '0x0585', 0.01), 2),
-            'power': format_value(get_register(values, '0x0586', 0.01), 2)  # back to kW
-        },
-        'pv2': {
-            'voltage': format_value(get_register(values, '0x0587', 0.1), 1),
-            'current': format_value(get_register(values, '0x0588', 0.01), 2),
-            'power': format_value(get_register(values, '0x0589', 0.01), 2)  # back to kW
-        },
-        'grid': {
-            'frequency': format_value(get_register(values, '0x0484', 0.01), 2),
-            'voltage': {
-                'phase_r': format_value(get_register(values, '0x048D', 0.1), 1),
-                'phase_s': format_value(get_register(values, '0x0498', 0.1), 1),
-                'phase_t': format_value(get_register(values, '0x04A3', 0.1), 1)
-            },
-            'generation': {
-                'total': {
-                    'active': format_value(get_register(values, '0x0485', 0.01, True), 2),  # back to kW
-                    'reactive': format_value(get_register(values, '0x0486', 0.01, True), 2),
-                    'apparent': format_value(get_register(values, '0x0487', 0.01, True), 2)
-                },
-                'phase_r': {
-                    'current': format_value(get_register(values, '0x048E', 0.01), 2),
-                    'active_power': format_value(get_register(values, '0x048F', 0.01, True), 2),  # back to kW
-                    'reactive_power': format_value(get_register(values, '0x0490', 0.01, True), 2),
-                    'power_factor': format_value(get_register(values, '0x0491', 0.001, True), 3)
-                },
-                'phase_s': {
-                    'current': format_value(get_register(values, '0x0499', 0.01), 2),
-                    'active_power': format_value(get_register(values, '0x049A', 0.01, True), 2),  # back to kW
-                    'reactive_power': format_value(get_register(values, '0x049B', 0.01, True), 2),
-                    'power_factor': format_value(get_register(values, '0x049C', 0.001, True), 3)
-                },
-                'phase_t': {
-                    'current': format_value(get_register(values, '0x04A4', 0.01), 2),
-                    'active_power': format_value(get_register(values, '0x04A5', 0.01, True), 2),  # back to kW
-                    'reactive_power': format_value(get_register(values, '0x04A6', 0.01, True), 2),
-                    'power_factor': format_value(get_register(values, '0x04A7', 0.001, True), 3)
-                }
-            },
-
-            'pcc': {
-                'total': {
-                    'active': format_value(get_register(values, '0x0488', 0.01, True), 2),  # back to kW
-                    'reactive': format_value(get_register(values, '0x0489', 0.01, True), 2),
-                    'apparent': format_value(get_register(values, '0x048A', 0.01, True), 2),
-                    'sys_load': format_value(get_register(values, '0x04AF', 0.01, True), 2)
-                },
-                'phase_r': {
-                    'current': format_value(get_register(values, '0x0492', 0.01), 2),
-                    'active_power': format_value(get_register(values, '0x0493', 0.01, True), 2),  # back to kW
-                    'reactive_power': format_value(get_register(values, '0x0494', 0.01, True), 2),
-                    'power_factor': format_value(get_register(values, '0x0495', 0.001, True), 3)
-                },
-                'phase_s': {
-                    'current': format_value(get_register(values, '0x049D', 0.01), 2),
-                    'active_power': format_value(get_register(values, '0x049E', 0.01, True), 2),  # back to kW
-                    'reactive_power': format_value(get_register(values, '0x049F', 0.01, True), 2),
-                    'power_factor': format_value(get_register(values, '0x04A0', 0.001, True), 3)
-                },
-                'phase_t': {
-                    'current': format_value(get_register(values, '0x04A8', 0.01), 2),
-                    'active_power': format_value(get_register(values, '0x04A9', 0.01, True), 2),  # back to kW
-                    'reactive_power': format_value(get_register(values, '0x04AA', 0.01, True), 2),
-                    'power_factor': format_value(get_register(values, '0x04AB', 0.001, True), 3)
-                }
-            }
-        },
-        'off_grid': {
-            'frequency': format_value(get_register(values, '0x0507', 0.01), 2),
-            'total': {
-                'active': format_value(get_register(values, '0x0504', 0.01, True), 2),  # back to kW
-                'reactive': format_value(get_register(values, '0x0505', 0.01, True), 2),
-                'apparent': format_value(get_register(values, '0x0506', 0.01, True), 2)
-            },
-            'phase_r': {
-                'voltage': format_value(get_register(values, '0x050A', 0.1), 1),
-                'current': format_value(get_register(values, '0x050B', 0.01), 2),
-                'active_power': format_value(get_register(values, '0x050C', 0.01, True), 2),  # back to kW
-                'reactive_power': format_value(get_register(values, '0x050D', 0.01, True), 2),
-                'apparent_power': format_value(get_register(values, '0x050E', 0.01, True), 2)
-            },
-            'phase_s': {
-                'voltage': format_value(get_register(values, '0x0512', 0.1), 1),
-                'current': format_value(get_register(values, '0x0513', 0.01), 2),
-                'active_power': format_value(get_register(values, '0x0514', 0.01, True), 2),  # back to kW
-                'reactive_power': format_value(get_register(values, '0x0515', 0.01, True), 2),
-                'apparent_power': format_value(get_register(values, '0x0516', 0.01, True), 2)
-            },
-            'phase_t': {
-                'voltage': format_value(get_register(values, '0x051A', 0.1), 1),
-                'current': format_value(get_register(values, '0x051B', 0.01), 2),
-                'active_power': format_value(get_register(values, '0x051C', 0.01, True), 2),  # back to kW
-                'reactive_power': format_value(get_register(values, '0x051D', 0.01, True), 2),
-                'apparent_power': format_value(get_register(values, '0x051E', 0.01, True), 2)
-            }
-        },
-        'generation': {
-            'daily': format_value(get_32bit_register(values, '0x0684', '0x0685', 0.01), 2),  # kWh values
-            'total': format_value(get_32bit_register(values, '0x0686', '0x0687', 0.1), 1),  # kWh values
-            'load_daily': format_value(get_32bit_register(values, '0x0688', '0x0689', 0.01), 2),  # kWh values
-            'load_total': format_value(get_32bit_register(values, '0x068A', '0x068B', 0.1), 1),  # kWh values
-            'bought_daily': format_value(get_32bit_register(values, '0x068C', '0x068D', 0.01), 2),  # kWh values
-            'bought_total': format_value(get_32bit_register(values, '0x068E', '0x068F', 0.1), 1),  # kWh values
-            'sold_daily': format_value(get_32bit_register(values, '0x0690', '0x0691', 0.01), 2),  # kWh values
-            'sold_total': format_value(get_32bit_register(values, '0x0692', '0x0693', 0.1), 1),  # kWh values
-            'battery_charge_daily': format_value(get_32bit_register(values, '0x0694', '0x0695', 0.01), 2),  # kWh values
-            'battery_charge_total': format_value(get_32bit_register(values, '0x0696', '0x0697', 0.1), 1),  # kWh values
-            'battery_discharge_daily': format_value(get_32bit_register(values, '0x0698', '0x0699', 0.01), 2),  # kWh values
-            'battery_discharge_total': format_value(get_32bit_register(values, '0x069A', '0x069B', 0.1), 1)  # kWh values
-        },
-        'faults': interpret_fault_codes(values),
-        'batteries': get_battery_metrics(values)
-    }
+    return decode_register_map(values)
 
 def print_data(data):
     """Print formatted data to console"""
@@ -463,7 +1108,7 @@ def print_data(data):
         if data['faults']:
             print("Active Faults:")
             for fault in data['faults']:
-                print(f"  - {fault}")
+                print(f"  - {fault['description']}")
         else:
             print("No active faults")
 
@@ -624,8 +1269,15 @@ def print_data(data):
                 if settings['eps_buffer'] is not None:
                     print(f"  EPS Buffer: {settings['eps_buffer']}%")
 
-def format_prometheus(data, inverter_name="inverter"):
-    """Format data as Prometheus metrics following consistent labeling convention."""
+def scaled(value, factor):
+    """Return value * factor, or None for a value that was not read"""
+    return None if value is None else value * factor
+
+def format_prometheus(data, inverter_name="inverter", inverter_label=None):
+    """Format data as Prometheus metrics following consistent labeling convention.
+
+    inverter_label adds an inverter="<label>" label to every metric when several inverters are exported.
+    """
     metrics = []
 
     metrics.append(f'{inverter_name}{{stats="state"}} {data["status"]["state_decimal"]}')
@@ -637,8 +1289,8 @@ def format_prometheus(data, inverter_name="inverter"):
 
     # Fault metrics
     metrics.append(f'{inverter_name}{{stats="fault_count"}} {len(data["faults"])}')
-    for code in data['faults']:
-        metrics.append(f'{inverter_name}{{stats="fault",code="{code}"}} 1')
+    for fault in data['faults']:
+        metrics.append(f'{inverter_name}{{stats="fault",code="{fault["id"]}"}} 1')
 
     # AC metrics
     metrics.append(f'{inverter_name}{{ac="frequency"}} {data["grid"].get("frequency", 0)}')
@@ -661,18 +1313,18 @@ def format_prometheus(data, inverter_name="inverter"):
         
         # Generated power metrics (* 1000 for watts)
         gen_data = data["grid"]["generation"].get(old_phase, {})
-        gen_power = gen_data.get("active_power", 0) * 1000
+        gen_power = scaled(gen_data.get("active_power", 0), 1000)
         metrics.append(f'{inverter_name}{{ac="generated_power",phase="{new_phase}"}} {gen_power}')
         
         # Load power (calculated from grid exchange) (* 1000 for watts)
         pcc_data = data["grid"]["pcc"].get(old_phase, {})
-        load_power = pcc_data.get("active_power", 0) * -1000
+        load_power = scaled(pcc_data.get("active_power", 0), -1000)
         metrics.append(f'{inverter_name}{{ac="grid_power",phase="{new_phase}"}} {load_power}')
 
     # Total power metrics (* 1000 for watts)
-    total_grid = data["grid"]["pcc"]["total"].get("active", 0) * -1000
-    total_sys_load = data["grid"]["pcc"]["total"].get("sys_load", 0) * 1000
-    total_generated = data["grid"]["generation"]["total"].get("active", 0) * 1000
+    total_grid = scaled(data["grid"]["pcc"]["total"].get("active", 0), -1000)
+    total_sys_load = scaled(data["grid"]["pcc"]["total"].get("sys_load", 0), 1000)
+    total_generated = scaled(data["grid"]["generation"]["total"].get("active", 0), 1000)
     metrics.append(f'{inverter_name}{{ac="total_grid_power"}} {total_grid}')
     metrics.append(f'{inverter_name}{{ac="total_load_power"}} {total_sys_load}')
     metrics.append(f'{inverter_name}{{ac="total_generated_power"}} {total_generated}')
@@ -731,10 +1383,12 @@ def format_prometheus(data, inverter_name="inverter"):
         generation_power = gen_data.get("active_power", 0)
         
         pcc_data = data["grid"]["pcc"].get(old_phase, {})
-        pcc_power = abs(pcc_data.get("active_power", 0))
+        pcc_power = pcc_data.get("active_power", 0)
         
         # Calculate load power for this phase
-        phase_load_power = round((generation_power + pcc_power) * 1000)
+        phase_load_power = None
+        if generation_power is not None and pcc_power is not None:
+            phase_load_power = round((generation_power + abs(pcc_power)) * 1000)
         # Output all power metrics (* 1000 for watts)
         metrics.append(f'{inverter_name}{{ac="load_power",phase="{new_phase}"}} {phase_load_power}')
 
@@ -779,66 +1433,879 @@ def format_prometheus(data, inverter_name="inverter"):
  #                   metrics.append(f'{inverter_name}{{eps="power",type="apparent",phase="{new_phase}"}} {p["apparent_power"] * 1000}')
 
 
-    return "\n".join(metrics)
+    # Values that were not read are left out instead of being exported as None
+    metrics = [m for m in metrics if not m.endswith(' None')]
+
+    return add_inverter_label("\n".join(metrics), inverter_label)
+
+def add_inverter_label(text, inverter_label=None):
+    """Add an inverter="<label>" label to every metric of a Prometheus text, unless inverter_label is None"""
+    if inverter_label is None:
+        return text
+    return "\n".join(line.replace('{', f'{{inverter="{inverter_label}",', 1) for line in text.split("\n"))
+
+
+def decoder_registers(register_map=REGISTER_MAP):
+    """Return the sorted registers that the register map and the fault decoder read"""
+    registers = set(FAULT_DEFINITIONS)
+    for entry in register_map:
+        source = entry[1]
+        if isinstance(source, tuple):
+            registers.update(source)
+        elif not callable(source):
+            registers.add(source)
+    return sorted(registers)
+
+# Registers the decoders need, known once at startup
+DECODER_REGISTERS = decoder_registers()
+
+def plan_ranges(registers, max_registers=125, frame_cost=16, gap_cost=1):
+    """Group registers into request frames at the lowest cost
+
+    Every frame costs frame_cost and every unneeded register read to bridge a gap costs gap_cost,
+    so gaps shorter than frame_cost / gap_cost are read through. A frame never spans more than
+    max_registers registers. Returns a list of (start, count) tuples.
+    """
+    regs = sorted(set(registers))
+
+    # best[i] is the cost of the cheapest plan covering regs[:i], whose last frame starts at regs[first[i]]
+    best = [0] + [None] * len(regs)
+    first = [0] * (len(regs) + 1)
+    for i in range(1, len(regs) + 1):
+        for j in range(i - 1, -1, -1):
+            span = regs[i - 1] - regs[j] + 1
+            if span > max_registers:
+                break
+            cost = best[j] + frame_cost + (span - (i - j)) * gap_cost
+            if best[i] is None or cost < best[i]:
+                best[i] = cost
+                first[i] = j
+
+    plan = []
+    i = len(regs)
+    while i > 0:
+        j = first[i]
+        plan.append((regs[j], regs[i - 1] - regs[j] + 1))
+        i = j
+    plan.reverse()
+    return plan
+
+def plan_for(config):
+    """Plan the decoder registers with the cost model from a config section"""
+    return plan_ranges(DECODER_REGISTERS, config['max_registers'], config['frame_cost'], config['gap_cost'])
+
+# Registers that change slowly or never; they are polled less often than the power values
+# in the "fast" tier by the exporter
+TIER_REGISTERS = {
+    'slow': range(0x0684, 0x069C),    # energy counters
+    'static': range(0x104D, 0x1053),  # battery settings
+}
+TIERS = ('fast', 'slow', 'static')
+
+def register_tier(reg):
+    """Return the poll tier of a register"""
+    for tier, registers in TIER_REGISTERS.items():
+        if reg in registers:
+            return tier
+    return 'fast'
+
+def plan_tiers(config, registers=DECODER_REGISTERS):
+    """Plan every tier's registers separately; returns {tier: [(start, count), ...]}"""
+    tiers = {tier: [] for tier in TIERS}
+    for reg in registers:
+        tiers[register_tier(reg)].append(reg)
+    return {tier: plan_ranges(regs, config['max_registers'], config['frame_cost'], config['gap_cost'])
+            for tier, regs in tiers.items() if regs}
+
+def due_tiers(tier_plans, last_polled, intervals, now):
+    """Return the tiers whose last complete poll is at least their interval old"""
+    return [tier for tier in tier_plans if now - last_polled.get(tier, 0) >= intervals[tier]]
+
+def describe_plan(plan, registers=DECODER_REGISTERS):
+    """Describe a register plan, one line per frame"""
+    needed = set(registers)
+    total = sum(count for start, count in plan)
+    lines = [f"Register plan: {len(plan)} frame(s), {total} register(s) read, {total - len(needed)} unused"]
+    for start, count in plan:
+        unused = sum(1 for reg in range(start, start + count) if reg not in needed)
+        lines.append(f"  0x{start:04X}-0x{start + count - 1:04X}  {count} register(s), {unused} unused")
+    return "\n".join(lines)
+
+def range_deadline(cycle_deadline, ranges_left):
+    """Deadline for the next range: twice its share of the time left in the cycle, at most all of it"""
+    if cycle_deadline is None:
+        return None
+    remaining = cycle_deadline - time.monotonic()
+    return time.monotonic() + min(remaining, 2 * remaining / ranges_left)
+
+def poll_registers(session, inverter_sn, plan, verbose=False, retries=2, budget=None, capture=None,
+                   before_range=None):
+    """Query every (start, count) range of a plan over one session and merge the values
+
+    A range whose response fails validation is requested again on its own, up to retries times.
+    budget bounds the whole cycle in seconds and is spread over the ranges; the cycle is abandoned
+    as soon as the logger cannot be reached. Valid responses are appended to capture if given.
+    before_range(session) is called before every range, e.g. to send writes ahead of the remaining
+    reads; the cycle stops early when it returns False.
+    """
+    session.reset_stats()
+    image = RegisterImage()
+    cycle_deadline = time.monotonic() + budget if budget else None
+
+    for index, (start, count) in enumerate(plan):
+        if cycle_deadline is not None and time.monotonic() >= cycle_deadline:
+            print(f"Cycle budget of {budget}s used up, skipping {len(plan) - index} range(s)")
+            break
+        if before_range is not None and not before_range(session):
+            break
+        for attempt in range(retries + 1):
+            frame = create_frame(inverter_sn, start, count, verbose, session.next_sequence())
+            session.stats['retries'] += attempt > 0
+            try:
+                sent = time.monotonic()
+                response = session.request(frame, deadline=range_deadline(cycle_deadline, len(plan) - index))
+                if response is None:
+                    print(f"Logger unreachable, skipping {len(plan) - index} range(s)")
+                    return image
+                session.stats['latency'].append((start, count, time.monotonic() - sent))
+                check_response(response, count)
+                decode_started = time.perf_counter()
+                process_response(response, start, count, verbose, image)
+                session.stats['decode_seconds'] += time.perf_counter() - decode_started
+                if capture is not None:
+                    record_response(capture, start, count, response)
+                break
+            except FrameError as e:
+                report_frame_error(session, e, start, count, attempt < retries)
+            except ModbusError as e:
+                print(f"Range 0x{start:04X}+{count}: {e}")
+                break
+
+    return image
+
+def write_blocks(writes):
+    """Group {register: value} into (start, [values]) blocks of consecutive registers for 0x10 writes"""
+    blocks = []
+    for reg in sorted(writes):
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == reg and len(blocks[-1][1]) < MAX_WRITE_REGISTERS:
+            blocks[-1][1].append(writes[reg])
+        else:
+            blocks.append((reg, [writes[reg]]))
+    return blocks
+
+def send_write(session, inverter_sn, start, values, dialect="v5", verbose=False, deadline=None):
+    """Send one block of consecutive register values in a write dialect; returns whether it was acknowledged
+
+    v5 writes with a 0x10 request in the logger framing, rtu with a bare RTU 0x10 frame and hyd
+    with one HYD frame per register. Raises FrameError or ModbusError for an invalid v5 answer.
+    """
+    if dialect == "v5":
+        response = session.request(create_write_frame(inverter_sn, start, values, verbose, session.next_sequence()),
+                                   deadline=deadline)
+        if response is None:
+            return False
+        check_write_response(response, start, len(values))
+        return True
+
+    if dialect == "rtu":
+        frame = create_rtu_write_frame(start, values, verbose)
+        reply = session.request_raw(frame, 8, deadline)
+        return reply is not None and is_rtu_write_reply(reply, frame)
+
+    for offset, value in enumerate(values):
+        frame = create_hyd_write_frame(start + offset, value, verbose)
+        if not is_hyd_write_reply(session.request_raw(frame, deadline=deadline), frame):
+            return False
+    return True
+
+def read_back_registers(session, inverter_sn, start, count, verbose=False, deadline=None):
+    """Read a block of registers back after a write; returns the image, or None if there was no answer"""
+    response = session.request(create_frame(inverter_sn, start, count, verbose, session.next_sequence()), deadline=deadline)
+    if response is None:
+        return None
+    check_response(response, count)
+    return process_response(response, start, count)
+
+def write_registers(session, inverter_sn, writes, verbose=False, retries=1, dialect="v5"):
+    """Write {register: value} in blocks of consecutive registers and read every block back
+
+    Each block is written with one request in the given write dialect (see send_write()) and read
+    back over the same session as soon as the inverter has acknowledged it. Returns
+    {register: value read back, or None if unconfirmed}.
+    """
+    results = {}
+    for start, values in write_blocks(writes):
+        read_back = None
+        for attempt in range(retries + 1):
+            try:
+                if not send_write(session, inverter_sn, start, values, dialect, verbose):
+                    break
+                read_back = read_back_registers(session, inverter_sn, start, len(values), verbose)
+                break
+            except FrameError as e:
+                report_frame_error(session, e, start, len(values), attempt < retries)
+            except ModbusError as e:
+                print(f"Write 0x{start:04X}+{len(values)}: {e}")
+                break
+
+        for reg in range(start, start + len(values)):
+            results[reg] = read_back[reg] if read_back is not None else None
+    return results
+
+WRITE_DIALECTS = ("v5", "rtu", "hyd")
+PROBE_TIMEOUT = 3  # seconds to wait for a logger to answer a dialect it may not understand
+
+def probe_write_dialect(session, inverter_sn, register, verbose=False):
+    """Find the write dialect a logger accepts by writing the current value of a register back to it
+
+    The dialects are tried in the order of WRITE_DIALECTS; the first one acknowledged and read back
+    is returned, or None if the register cannot be read or no dialect works.
+    """
+    try:
+        image = read_back_registers(session, inverter_sn, register, 1, verbose)
+    except (FrameError, ModbusError) as e:
+        print(f"Probe read of 0x{register:04X}: {e}")
+        return None
+    if image is None:
+        return None
+
+    value = image[register]
+    for dialect in WRITE_DIALECTS:
+        deadline = time.monotonic() + PROBE_TIMEOUT
+        try:
+            if send_write(session, inverter_sn, register, [value], dialect, verbose, deadline):
+                read_back = read_back_registers(session, inverter_sn, register, 1, verbose, deadline)
+                if read_back is not None and read_back[register] == value:
+                    return dialect
+        except (FrameError, ModbusError, socket.error) as e:
+            if verbose:
+                print(f"Write dialect {dialect}: {e}")
+        if verbose:
+            print(f"Write dialect {dialect} not accepted")
+    return None
+
+def load_write_dialects(path):
+    """Load the cached {logger serial: write dialect}"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
+def get_write_dialect(session, config, register, verbose=False):
+    """Return the write dialect of the configured logger, probing it with register on first use
+
+    write_dialect in the config overrides the detection. The probed dialect is cached per logger
+    serial in dialect_cache, so later writes use it directly; None if no dialect works.
+    """
+    if config['write_dialect'] != "auto":
+        return config['write_dialect']
+
+    dialects = load_write_dialects(config['dialect_cache'])
+    dialect = dialects.get(str(config['inverter_sn']))
+    if dialect in WRITE_DIALECTS:
+        return dialect
+
+    dialect = probe_write_dialect(session, config['inverter_sn'], register, verbose)
+    if dialect is not None:
+        print(f"Logger {config['inverter_sn']} accepts {dialect} writes")
+        dialects[str(config['inverter_sn'])] = dialect
+        tmp_path = f"{config['dialect_cache']}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dialects, f, indent=2)
+        os.replace(tmp_path, config['dialect_cache'])
+    return dialect
+
+def load_write_times(path):
+    """Load {register: time last written}, shared by everything writing to the inverter"""
+    try:
+        with open(path) as f:
+            return {int(reg, 16): written for reg, written in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def save_write_times(path, write_times):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({f"0x{reg:04X}": written for reg, written in write_times.items()}, f)
+    os.replace(tmp_path, path)
+
+def write_registers_limited(session, config, writes, write_times_path, write_interval, verbose=False):
+    """Write {register: value} like write_registers(), unless one was written within write_interval
+
+    Settings are kept in EEPROM, so a register is written at most once per write_interval seconds.
+    Returns (results, retry_after): the results of write_registers() and 0, or None and the seconds
+    until all registers may be written again. The caller holds the snapshot lock, so the write
+    times are not updated by two writers at once.
+    """
+    write_times = load_write_times(write_times_path)
+    now = time.time()
+    retry_after = max(write_times.get(reg, 0) + write_interval - now for reg in writes)
+    if retry_after > 0:
+        return None, retry_after
+
+    dialect = get_write_dialect(session, config, min(writes), verbose)
+    if dialect is None:
+        return dict.fromkeys(writes), 0
+    results = write_registers(session, config['inverter_sn'], writes, verbose, dialect=dialect)
+    write_times.update((reg, now) for reg, value in results.items() if value is not None)
+    save_write_times(write_times_path, write_times)
+    return results, 0
+
+def report_frame_error(session, error, start, count, retrying):
+    session.stats['frame_errors'] += 1
+    if isinstance(error, ChecksumError):
+        session.stats['checksum_failures'] += 1
+    print(f"Range 0x{start:04X}+{count}: {error}{', retrying' if retrying else ''}")
+
+class AsyncInverterSession:
+    """asyncio counterpart of InverterSession, used to poll several inverters concurrently"""
+
+    def __init__(self, ip, port, timeout=15, verbose=False):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.verbose = verbose
+        self.reader = None
+        self.writer = None
+        self.sequence = 0
+        self.reset_stats()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def reset_stats(self):
+        """Reset the per-cycle connect/transfer counters"""
+        self.stats = new_cycle_stats()
+
+    async def connect(self):
+        """Open a new connection to the logger, dropping any previous one"""
+        await self.close()
+        if self.verbose:
+            print(f"Connecting to {self.ip}:{self.port}")
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), self.timeout)
+        self.stats['connects'] += 1
+
+    async def close(self):
+        """Close the connection if it is open"""
+        if self.writer is not None:
+            writer = self.writer
+            self.reader = self.writer = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, asyncio.CancelledError):
+                pass
+
+    def next_sequence(self):
+        """Return the sequence number for the next request frame"""
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        return self.sequence
+
+    async def recv_response(self, request):
+        """Read whole frames until the response to request arrives"""
+        while True:
+            header = await self.reader.readexactly(HEADER_LENGTH)
+            try:
+                length = frame_length(header)
+            except FrameError:
+                await self.close()
+                raise
+            frame = header + await self.reader.readexactly(length - HEADER_LENGTH)
+            self.stats['bytes'] += length
+            if is_response_to(frame, request):
+                return frame
+            if self.verbose:
+                print("Skipping unrelated frame:", frame.hex())
+
+    async def request(self, frame, retries=1):
+        """Send a frame and return the response, reconnecting transparently on failure"""
+        for attempt in range(retries + 1):
+            try:
+                if self.writer is None:
+                    try:
+                        await self.connect()
+                    except (OSError, asyncio.TimeoutError):
+                        self.stats['connect_failures'] += 1
+                        raise
+                self.writer.write(frame)
+                await self.writer.drain()
+                data = await asyncio.wait_for(self.recv_response(frame), self.timeout)
+                self.stats['transfers'] += 1
+
+                if self.verbose:
+                    print("Raw data received:", data.hex())
+
+                return data
+
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                await self.close()
+                self.stats['failures'] += 1
+                if attempt < retries:
+                    self.stats['reconnects'] += 1
+                    if self.verbose:
+                        print(f"Socket error: {e}, reconnecting")
+                else:
+                    print(f"Socket error ({self.ip}): {e}")
+        return None
+
+async def poll_registers_async(session, inverter_sn, plan, verbose=False, retries=2):
+    """Query every (start, count) range of a plan over one asyncio session and merge the values"""
+    session.reset_stats()
+    image = RegisterImage()
+
+    for index, (start, count) in enumerate(plan):
+        for attempt in range(retries + 1):
+            frame = create_frame(inverter_sn, start, count, verbose, session.next_sequence())
+            session.stats['retries'] += attempt > 0
+            try:
+                sent = time.monotonic()
+                response = await session.request(frame)
+                if response is None:
+                    print(f"Logger unreachable, skipping {len(plan) - index} range(s)")
+                    return image
+                session.stats['latency'].append((start, count, time.monotonic() - sent))
+                check_response(response, count)
+                decode_started = time.perf_counter()
+                process_response(response, start, count, verbose, image)
+                session.stats['decode_seconds'] += time.perf_counter() - decode_started
+                break
+            except FrameError as e:
+                report_frame_error(session, e, start, count, attempt < retries)
+            except ModbusError as e:
+                print(f"Range 0x{start:04X}+{count}: {e}")
+                break
+
+    return image
+
+async def poll_inverter_async(inverter):
+    """Poll one inverter within its own deadline; returns an empty image if it does not finish in time"""
+    verbose = inverter['verbose'] == "1"
+    started = time.monotonic()
+    async with AsyncInverterSession(inverter['inverter_ip'], inverter['inverter_port'],
+                                    timeout=inverter['deadline'], verbose=verbose) as session:
+        try:
+            values = await asyncio.wait_for(
+                poll_registers_async(session, inverter['inverter_sn'], plan_for(inverter), verbose),
+                inverter['deadline'])
+        except asyncio.TimeoutError:
+            print(f"Inverter {inverter['name']}: no answer within {inverter['deadline']}s")
+            values = RegisterImage()
+
+    if verbose:
+        print(f"Inverter {inverter['name']}: {time.monotonic() - started:.2f}s, "
+              f"{session.stats['connects']} connect(s), {session.stats['transfers']} transfer(s)")
+    return values
+
+async def poll_fleet(inverters):
+    """Poll all inverters concurrently; the cycle takes as long as the slowest one"""
+    results = await asyncio.gather(*(poll_inverter_async(inverter) for inverter in inverters))
+    return {inverter['name']: values for inverter, values in zip(inverters, results)}
+
+def print_fleet(inverters, fleet_values, output_format):
+    """Print the data of several inverters in the requested format"""
+    fleet_data = {}
+    for inverter in inverters:
+        values = fleet_values[inverter['name']]
+        fleet_data[inverter['name']] = format_data(values) if values else None
+
+    if output_format == "json":
+        print(json.dumps(fleet_data, indent=2))
+    elif output_format == "prometheus":
+        print("\n".join(format_prometheus(data, inverter_name="sofar", inverter_label=name)
+                        for name, data in fleet_data.items() if data is not None))
+    else:
+        for name, data in fleet_data.items():
+            print(f"\n##### Inverter {name} #####")
+            if data is not None:
+                print_data(data)
+            else:
+                print("No data received from inverter")
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Cycle counters that are summed over all cycles
+CYCLE_COUNTERS = ('connects', 'reconnects', 'failures', 'connect_failures', 'frame_errors', 'checksum_failures',
+                  'retries', 'bytes')
+
+def add_cycle_stats(totals, cycle, duration, failed=False):
+    """Add the counters and request latencies of one poll cycle to the running totals"""
+    totals['cycles'] = totals.get('cycles', 0) + 1
+    totals['cycle_failures'] = totals.get('cycle_failures', 0) + failed
+    totals['cycle_seconds'] = duration
+    totals['cycle_seconds_sum'] = totals.get('cycle_seconds_sum', 0) + duration
+    totals['decode_seconds'] = cycle['decode_seconds']
+    for key in CYCLE_COUNTERS:
+        totals[key] = totals.get(key, 0) + cycle[key]
+
+    # Cumulative histogram per register range, as Prometheus expects: buckets[i] counts requests <= bound i
+    ranges = totals.setdefault('ranges', {})
+    for start, count, seconds in cycle['latency']:
+        histogram = ranges.setdefault(f"0x{start:04X}+{count}",
+                                      {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0, 'count': 0})
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+    return totals
+
+def format_poll_metrics(totals, inverter_name="sofar"):
+    """Format the poll statistics in Prometheus format"""
+    lines = []
+    for key in ('cycles', 'cycle_failures', 'cycle_seconds', 'cycle_seconds_sum', 'decode_seconds') + CYCLE_COUNTERS:
+        if key in totals:
+            lines.append(f'{inverter_name}{{poll="{key}"}} {totals[key]:g}')
+
+    for name, histogram in totals.get('ranges', {}).items():
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            lines.append(f'{inverter_name}{{poll="request_seconds",range="{name}",le="{bound}"}} {count}')
+        lines.append(f'{inverter_name}{{poll="request_seconds",range="{name}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'{inverter_name}{{poll="request_seconds_sum",range="{name}"}} {histogram["sum"]:.6f}')
+        lines.append(f'{inverter_name}{{poll="request_seconds_count",range="{name}"}} {histogram["count"]}')
+
+    return "\n".join(lines)
+
+def read_captures(path):
+    """Yield (timestamp, image) for every poll cycle recorded in a capture file
+
+    A cycle ends where a register range is recorded a second time.
+    """
+    image, ranges, started = RegisterImage(), set(), None
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = (record['start'], record['count'])
+            if key in ranges:
+                yield started, image
+                image, ranges = RegisterImage(), set()
+            if not ranges:
+                started = record['time']
+            ranges.add(key)
+            process_response(bytes.fromhex(record['response']), record['start'], record['count'], image=image)
+    if ranges:
+        yield started, image
+
+def read_recording(path):
+    """Yield (timestamp, image) from a register archive, a capture file or a saved register image"""
+    with open(path, 'rb') as f:
+        head = f.readline()
+    if head.startswith(ARCHIVE_MAGIC):
+        yield from read_archive(path)
+    elif b'"response"' in head:
+        yield from read_captures(path)
+    else:
+        yield os.path.getmtime(path), load_register_image(path)
+
+def replay(path, output_format):
+    """Decode and print every recorded image as fast as possible, stamped with its recording time"""
+    for recorded, image in read_recording(path):
+        data = format_data(image)
+        data['timestamp'] = datetime.fromtimestamp(recorded).isoformat()
+        if output_format == "json":
+            # One object per line, so the stream can be processed line by line
+            print(json.dumps(data))
+        elif output_format == "prometheus":
+            milliseconds = int(recorded * 1000)
+            print("\n".join(f"{line} {milliseconds}" for line in format_prometheus(data, inverter_name="sofar").splitlines()))
+        else:
+            print(f"\n##### {data['timestamp']} #####")
+            print_data(data)
+
+# Returned by a poll cycle that gave up the logger before finishing; neither data nor a failure
+POLL_YIELDED = object()
+
+class SnapshotStore:
+    """File-backed snapshot shared between processes, refreshed by at most one poller at a time"""
+
+    def __init__(self, path, ttl, backoff_max=300):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.ttl = ttl
+        self.backoff_max = backoff_max
+        self._cached = (None, None)  # (file identity, parsed snapshot)
+
+    def read(self):
+        """Return the stored snapshot, or None if nothing has been polled yet"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        # Only re-parse the file when another process has replaced it
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached_key, snapshot = self._cached
+        if key != cached_key:
+            try:
+                with open(self.path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                return snapshot
+            self._cached = (key, snapshot)
+        return snapshot
+
+    def is_fresh(self, snapshot):
+        return snapshot is not None and snapshot['timestamp'] is not None and time.time() - snapshot['timestamp'] < self.ttl
+
+    def is_backing_off(self, snapshot):
+        """Whether polling is suspended after failed cycles (the circuit is open)"""
+        return snapshot is not None and time.time() < snapshot.get('retry_at', 0)
+
+    def write(self, snapshot):
+        """Atomically replace the stored snapshot"""
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self, poll):
+        """Return a fresh snapshot, calling poll(state) only if no other process holds a fresh one
+
+        poll(state) may update state, a dict carried from snapshot to snapshot (poll statistics,
+        registers of the slower tiers and when they were read). It returns None when the cycle
+        failed; the last good data is then kept, and polling is suspended for the TTL, doubled after
+        every further failed cycle up to backoff_max seconds. Until then refresh() returns the stale
+        snapshot immediately. When poll(state) returns POLL_YIELDED the stored snapshot is left as it
+        is, so the next call polls again.
+        """
+        snapshot = self.read()
+        if self.is_fresh(snapshot) or self.is_backing_off(snapshot):
+            return snapshot
+
+        with self.lock():
+            # Whoever held the lock before us may have just polled
+            snapshot = self.read()
+            if self.is_fresh(snapshot) or self.is_backing_off(snapshot):
+                return snapshot
+
+            state = copy.deepcopy(snapshot.get('state', {})) if snapshot else {}
+            data = poll(state)
+            if data is POLL_YIELDED:
+                return snapshot
+            if data is not None:
+                snapshot = {'timestamp': time.time(), 'data': data, 'failures': 0, 'retry_at': 0}
+            else:
+                snapshot = dict(snapshot or {'timestamp': None, 'data': None})
+                snapshot['failures'] = snapshot.get('failures', 0) + 1
+                snapshot['retry_at'] = time.time() + min(self.backoff_max,
+                                                         self.ttl * 2 ** (snapshot['failures'] - 1))
+            snapshot['state'] = state
+            self.write(snapshot)
+
+        return snapshot
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the lock that gives one process at a time the connection to the logger"""
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def print_output(data, output_format=None):
+    """Print the decoded data in the requested format (human-readable text by default)"""
+    if output_format == "json":
+        print(json.dumps(data, indent=2))
+    elif output_format == "prometheus":
+        print(format_prometheus(data, inverter_name="sofar"))
+    else:
+        print_data(data)
+
+OUTPUT_FORMATS = ("text", "json", "prometheus")
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Answers one client: it sends the output format on one line and gets the latest output back"""
+
+    def handle(self):
+        output_format = self.rfile.readline().decode(errors='replace').strip() or "text"
+        self.wfile.write(self.server.monitor.answer(output_format).encode())
+
+class MonitorDaemon:
+    """Polls on an interval and serves the latest output to thin clients over a Unix socket
+
+    The config is loaded and the connection to the logger opened once; every poll is rendered in
+    all output formats right away, so a client gets a string that is ready to send.
+    """
+
+    def __init__(self, config, inverters, interval, archive=None):
+        self.config = config  # None when several inverters are polled
+        self.inverters = inverters
+        self.interval = interval
+        self.archive = archive
+        if config is not None:
+            self.verbose = config['verbose'] == "1"
+            self.plan = plan_for(config)
+            # Kept open between polls; the session reconnects when the logger drops the connection
+            self.session = InverterSession(config['inverter_ip'], config['inverter_port'], verbose=self.verbose)
+            self.max_age = 2 * interval + config['cycle_timeout']
+        else:
+            self.max_age = 2 * interval + max(inverter['deadline'] for inverter in inverters)
+        self.latest = (None, {})  # (time of the last poll that returned data, {output format: output})
+
+    def poll(self):
+        """Poll once; returns a function printing the data in an output format, or None if nothing was read"""
+        if self.config is None:
+            fleet_values = asyncio.run(poll_fleet(self.inverters))
+            if not any(fleet_values.values()):
+                return None
+            return lambda output_format: print_fleet(self.inverters, fleet_values, output_format)
+
+        values = poll_registers(self.session, self.config['inverter_sn'], self.plan, self.verbose,
+                                budget=self.config['cycle_timeout'])
+        if not values:
+            return None
+        data = format_data(values)
+        if self.archive is not None:
+            self.archive.append(time.time(), values)
+        return lambda output_format: print_output(data, output_format)
+
+    def refresh(self):
+        printer = self.poll()
+        if printer is None:
+            return
+        outputs = {}
+        for output_format in OUTPUT_FORMATS:
+            output = io.StringIO()
+            # Only this thread prints, so stdout can be redirected while rendering
+            with contextlib.redirect_stdout(output):
+                printer(output_format)
+            outputs[output_format] = output.getvalue()
+        self.latest = (time.time(), outputs)
+
+    def answer(self, output_format):
+        """Return the latest output in a format; data older than max_age is not served"""
+        polled, outputs = self.latest
+        if output_format not in OUTPUT_FORMATS:
+            return f"Unknown format {output_format}, expected one of: {', '.join(OUTPUT_FORMATS)}\n"
+        if polled is None or time.time() - polled > self.max_age:
+            return "No data received from inverter\n"
+        return outputs[output_format]
+
+    def run(self, socket_path):
+        if os.path.exists(socket_path):
+            if query_daemon(socket_path, "text", quiet=True) is not None:
+                raise SystemExit(f"A daemon is already listening on {socket_path}")
+            os.unlink(socket_path)
+
+        # Poll once before listening, so no client is answered without data after a restart
+        started = time.monotonic()
+        self.refresh()
+        server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler)
+        server.monitor = self
+        threading.Thread(target=server.serve_forever, name="sofar-daemon", daemon=True).start()
+        print(f"Serving on {socket_path}, polling every {self.interval:g}s")
+        try:
+            while True:
+                time.sleep(max(0, self.interval - (time.monotonic() - started)))
+                started = time.monotonic()
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Poll error: {e}")
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+            if self.config is not None:
+                self.session.close()
+            if self.archive is not None:
+                self.archive.close()
 
 def main():
     """Main function"""
     # Set up argument parsing
     parser = argparse.ArgumentParser(description="Monitor and log data from the Sofar inverter.")
     parser.add_argument("--format", choices=["json", "prometheus"], help="Output format: json or prometheus.")
+    parser.add_argument("--plan", action="store_true", help="Print the register request plan and exit.")
+    parser.add_argument("--record", metavar="FILE", help="Append the raw responses of this poll to a capture file.")
+    parser.add_argument("--archive", metavar="FILE", help="Append the registers of this poll to a register archive.")
+    parser.add_argument("--replay", metavar="FILE", help="Decode a register archive, capture file or register image instead of polling.")
+    parser.add_argument("--daemon", action="store_true", help="Keep polling and serve the latest output on a Unix socket.")
+    parser.add_argument("--from-daemon", action="store_true", help="Print the latest output of the running daemon instead of polling.")
+    parser.add_argument("--socket", default=DAEMON_SOCKET, help=f"Unix socket of the daemon (default: {DAEMON_SOCKET}).")
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between the polls of the daemon.")
     args = parser.parse_args()
 
+    if args.from_daemon:
+        # A --from-daemon command line that only has --format and --socket is answered before main()
+        parser.error("--from-daemon only takes --format and --socket")
+
+    if args.replay:
+        replay(args.replay, args.format)
+        return
+
+    capture_path = os.path.abspath(args.record) if args.record else None
+    archive_path = os.path.abspath(args.archive) if args.archive else None
+    socket_path = os.path.abspath(args.socket)
+
     # Change to script directory
     os.chdir(os.path.dirname(sys.argv[0]))
     
-    # Load configuration
-    config = load_config()
+    # Several inverter sections are polled concurrently
+    inverters = load_inverters()
+    if not inverters:
+        print("No [SofarInverter] section in config.cfg")
+        sys.exit(1)
+    if len(inverters) > 1:
+        if capture_path or archive_path:
+            # Captures and archives hold the registers of one inverter
+            parser.error("--record and --archive need a single inverter section")
+        if args.plan:
+            for inverter in inverters:
+                print(f"##### Inverter {inverter['name']} #####")
+                print(describe_plan(plan_for(inverter)))
+            return
+
+    if args.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        archive = RegisterArchive(archive_path) if archive_path else None
+        MonitorDaemon(inverters[0] if len(inverters) == 1 else None, inverters, args.interval, archive).run(socket_path)
+        return
+
+    if len(inverters) > 1:
+        print_fleet(inverters, asyncio.run(poll_fleet(inverters)), args.format)
+        return
+
+    # A single section is polled on its own, whatever its name
+    config = inverters[0]
+    plan = plan_for(config)
+
+    if args.plan or config['verbose'] == "1":
+        print(describe_plan(plan))
+        if args.plan:
+            return
     
-    # Define register ranges
-    register_ranges = [
-        ('0x0400', '0x0432'),  # Inverter status, temperatures
-        ('0x0445', '0x0465'),  # Serial number, versions
-        ('0x0480', '0x04BC'),  # Grid metrics
-        ('0x0504', '0x051F'),  # Off-grid
-        ('0x0580', '0x0589'),  # PV inputs
-        ('0x0600', '0x0611'),  # Battery 1
-        ('0x0684', '0x069B'),  # Generation data
-        ('0x104D', '0x104E'),  # Battery DOD and EOD
-        ('0x1052', '0x1052'),  # Battery EPS buffer
-    ]
-
-    # Store all register values
-    all_values = {}
-
-    # Query each register range
-    for start, end in register_ranges:
-        pini = int(start, 0)
-        pfin = int(end, 0)
-        
-        frame = create_frame(config['inverter_sn'], pini, pfin - pini + 1, config['verbose'] == "1")
-        response = query_registers(config['inverter_ip'], config['inverter_port'], frame, config['verbose'] == "1")
-        
-        if response:
-            values = process_response(response, pini, pfin - pini + 1, config['verbose'] == "1")
-            all_values.update(values)
+    # Query every register range over a single connection
+    with InverterSession(config['inverter_ip'], config['inverter_port'], verbose=config['verbose'] == "1") as session:
+        capture = open(capture_path, 'a') if capture_path else None
+        try:
+            all_values = poll_registers(session, config['inverter_sn'], plan, config['verbose'] == "1",
+                                        budget=config['cycle_timeout'], capture=capture)
+        finally:
+            if capture is not None:
+                capture.close()
+
+        if config['verbose'] == "1":
+            print(f"Cycle: {session.stats['connects']} connect(s), {session.stats['transfers']} transfer(s), "
+                  f"{session.stats['reconnects']} reconnect(s), {session.stats['retries']} retry(ies), "
+                  f"{session.stats['bytes']} byte(s) received")
 
     # Format the collected data
     if all_values:
         data = format_data(all_values)
-        
-        # Save to JSON file
-#        with open('inverter_data.json', 'w') as f:
-#            json.dump(data, f, indent=2)
-        
-        # Check output format
-        if args.format == "json":
-            print(json.dumps(data, indent=2))
-        elif args.format == "prometheus":
-            print(format_prometheus(data,inverter_name="sofar"))
-        else:
-            # Default: Print formatted text output
-            print_data(data)
+
+        if archive_path:
+            with RegisterArchive(archive_path) as archive:
+                archive.append(time.time(), all_values)
+
+        print_output(data, args.format)
     else:
         print("No data received from inverter")
 
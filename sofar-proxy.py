@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import signal
+import sys
+import time
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sofar_monitor_file = os.path.join(current_directory, "sofar-monitor.py")
+config_file = os.path.join(current_directory, "config.cfg")
+
+
+def load_sofar_monitor():
+    """Import sofar-monitor.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_monitor", sofar_monitor_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+sofar = load_sofar_monitor()
+
+
+def read_key(frame):
+    """Identify a read request by logger serial, slave, start and count; None for anything else"""
+    if len(frame) == 36 and frame[27] == 0x03:
+        return bytes(frame[7:11]) + bytes(frame[26:32])
+    return None
+
+
+class LoggerProxy:
+    """Forwards the frames of many local clients over one connection to the logger, one at a time"""
+
+    def __init__(self, session, window, verbose=False):
+        self.session = session
+        self.window = window
+        self.verbose = verbose
+        self.queue = asyncio.Queue()
+        self.reads = {}  # read key: (time requested, future of the response)
+        self.stats = {'clients': 0, 'requests': 0, 'forwarded': 0, 'deduplicated': 0, 'failed': 0}
+
+    async def submit(self, frame):
+        """Return the logger's response to a client frame, or None if the logger did not answer"""
+        self.stats['requests'] += 1
+        key = read_key(frame)
+        if key is not None:
+            # Reads older than the window are never shared again, so they are dropped here; otherwise
+            # a read-only workload would keep one entry for every range ever requested
+            now = time.monotonic()
+            self.reads = {read: entry for read, entry in self.reads.items() if now - entry[0] <= self.window}
+            # Identical reads within the window share one upstream request, even while it is in flight
+            entry = self.reads.get(key)
+            if entry is not None and not (entry[1].done() and entry[1].result() is None):
+                self.stats['deduplicated'] += 1
+                return await asyncio.shield(entry[1])
+
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self.reads[key] = (now, future)
+        # Every client waits for its answer before sending the next frame, so serving the
+        # queue in order gives each client its turn
+        await self.queue.put((frame, future))
+        return await asyncio.shield(future)
+
+    async def run(self):
+        while True:
+            frame, future = await self.queue.get()
+            try:
+                response = await self.session.request(sofar.set_sequence(frame, self.session.next_sequence()))
+            except sofar.FrameError as e:
+                print(f"Logger sent an invalid frame: {e}")
+                response = None
+
+            if read_key(frame) is None:
+                # A write may change any register, so earlier reads must not be reused
+                self.reads.clear()
+            self.stats['forwarded'] += 1
+            self.stats['failed'] += response is None
+            future.set_result(response)
+
+    async def handle(self, reader, writer):
+        self.stats['clients'] += 1
+        peer = writer.get_extra_info('peername')
+        if self.verbose:
+            print(f"Client {peer} connected")
+        try:
+            while True:
+                header = await reader.readexactly(sofar.HEADER_LENGTH)
+                frame = header + await reader.readexactly(sofar.frame_length(header) - sofar.HEADER_LENGTH)
+                response = await self.submit(frame)
+                if response is None:
+                    break  # the client sees the logger drop the connection, as it would without the proxy
+                # Answer with the client's own sequence number
+                writer.write(sofar.set_sequence(response, frame[5] | response[6] << 8))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, sofar.FrameError):
+            pass
+        finally:
+            writer.close()
+            if self.verbose:
+                print(f"Client {peer} disconnected")
+
+
+async def serve(proxy, host, port):
+    server = await asyncio.start_server(proxy.handle, host, port)
+    print(f"Proxying {proxy.session.ip}:{proxy.session.port} on {host}:{port}")
+    async with server, proxy.session:
+        await asyncio.gather(server.serve_forever(), proxy.run())
+
+def main():
+    parser = argparse.ArgumentParser(description="Share one connection to the Sofar data logger between many local clients.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8899, help="Port to listen on")
+    parser.add_argument("--window", type=float, default=1.0,
+                        help="Seconds during which identical reads are answered by one logger request")
+    parser.add_argument("--timeout", type=float, default=5, help="Seconds to wait for the logger")
+    parser.add_argument("--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("--inverter", help="Name of the [SofarInverter:<name>] section to use (default: [SofarInverter] or the only section)")
+    args = parser.parse_args()
+
+    try:
+        config = sofar.select_inverter(sofar.load_inverters(config_file), args.inverter)
+    except ValueError as e:
+        parser.error(str(e))
+    session = sofar.AsyncInverterSession(config['inverter_ip'], config['inverter_port'], timeout=args.timeout,
+                                         verbose=args.verbose)
+    proxy = LoggerProxy(session, args.window, args.verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        asyncio.run(serve(proxy, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(", ".join(f"{key}: {value}" for key, value in proxy.stats.items()))
+
+if __name__ == "__main__":
+    main()
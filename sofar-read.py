@@ -3,8 +3,26 @@
 import socket
 import binascii
 import libscrc
-import configparser
 import argparse
+import contextlib
+import csv
+import importlib.util
+import json
+import os
+import sys
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sofar_monitor_file = os.path.join(current_directory, "sofar-monitor.py")
+config_file = os.path.join(current_directory, "config.cfg")
+
+def load_sofar_monitor():
+    """Import sofar-monitor.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_monitor", sofar_monitor_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+sofar = load_sofar_monitor()
 
 def padhex(s):
     return '0x' + s[2:].zfill(4)
@@ -13,18 +31,6 @@ def hex_zfill(intval):
     hexvalue = hex(intval)
     return '0x' + str(hexvalue)[2:].zfill(4)
 
-def load_config(config_path='./config.cfg'):
-    """Load configuration from file"""
-    configParser = configparser.RawConfigParser()
-    configParser.read(config_path)
-    
-    return {
-        'inverter_ip': configParser.get('SofarInverter', 'inverter_ip'),
-        'inverter_port': int(configParser.get('SofarInverter', 'inverter_port')),
-        'inverter_sn': int(configParser.get('SofarInverter', 'inverter_sn')),
-        'verbose': configParser.get('SofarInverter', 'verbose')
-    }
-
 def create_read_frame(inverter_sn, register, num_registers=1, verbose=False):
     """Create the Modbus frame for reading registers"""
     start = binascii.unhexlify('A5')
@@ -118,17 +124,92 @@ def process_response(data, verbose=False):
         print("Error converting response to decimal")
         return None
 
+def parse_registers(text):
+    """Parse a register list like "0x0404,0x0418,0x0484-0x0489" (ranges are inclusive)"""
+    registers = set()
+    for item in text.split(','):
+        first, _, last = item.strip().partition('-')
+        registers.update(range(int(first, 0), int(last or first, 0) + 1))
+    return sorted(registers)
+
+def describe_registers(image, registers):
+    """Return one dict per register read: raw value and its signed and 32-bit interpretations"""
+    rows = []
+    for reg in registers:
+        if reg not in image:
+            continue
+        value = image[reg]
+        row = {'register': f"0x{reg:04X}", 'value': value, 'hex': f"0x{value:04x}",
+               'signed': (value ^ 0x8000) - 0x8000, 'u32': None, 's32': None}
+        # 32-bit values span this register (high word) and the next one (low word)
+        if reg < 0xFFFF and reg + 1 in image:
+            row['u32'] = (value << 16) | image[reg + 1]
+            row['s32'] = (row['u32'] ^ 0x80000000) - 0x80000000
+        rows.append(row)
+    return rows
+
+def read_registers(config, registers, output_format=None, verbose=False):
+    """Read many registers in as few frames as possible over one connection and print them
+
+    Returns whether every register was read.
+    """
+    plan = sofar.plan_ranges(registers, config['max_registers'], config['frame_cost'], config['gap_cost'])
+    # Keep socket and frame errors out of JSON and CSV output, which is meant for other programs
+    with contextlib.redirect_stdout(sys.stderr) if output_format else contextlib.nullcontext():
+        with sofar.InverterSession(config['inverter_ip'], config['inverter_port'], verbose=verbose) as session:
+            image = sofar.poll_registers(session, config['inverter_sn'], plan, verbose, budget=config['cycle_timeout'])
+
+    rows = describe_registers(image, registers)
+    if output_format == "json":
+        print(json.dumps(rows, indent=2))
+    elif output_format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=['register', 'value', 'hex', 'signed', 'u32', 's32'])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            print(f"Register {row['register']} value: {row['value']} ({row['hex']}), signed: {row['signed']}"
+                  + (f", 32-bit: {row['u32']} / {row['s32']}" if row['u32'] is not None else ""))
+    if len(rows) < len(registers):
+        print(f"{len(registers) - len(rows)} register(s) could not be read", file=sys.stderr)
+        return False
+    return True
+
 def main():
     parser = argparse.ArgumentParser(description="Read a specific register from Sofar inverter.")
-    parser.add_argument("--register", type=lambda x: int(x, 0), required=True,
+    parser.add_argument("--register", type=lambda x: int(x, 0),
                       help="Register to read (in hex, e.g., 0x1062)")
+    parser.add_argument("--start", type=lambda x: int(x, 0),
+                      help="First register of a range to read")
+    parser.add_argument("--count", type=int, default=1,
+                      help="Number of registers to read from --start")
+    parser.add_argument("--registers", type=parse_registers,
+                      help="Registers to read, e.g. 0x0404,0x0418,0x0484-0x0489")
+    parser.add_argument("--format", choices=["json", "csv"],
+                      help="Output format for --start/--registers: json or csv")
     parser.add_argument("--verbose", action="store_true",
                       help="Enable verbose output")
+    parser.add_argument("--inverter",
+                      help="Name of the [SofarInverter:<name>] section to use (default: [SofarInverter] or the only section)")
     args = parser.parse_args()
 
-    # Load configuration
-    config = load_config()
-    
+    try:
+        config = sofar.select_inverter(sofar.load_inverters(config_file), args.inverter)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Ranges and lists are fetched in as few frames as the logger allows
+    if args.start is not None or args.registers:
+        registers = set(args.registers or [])
+        if args.start is not None:
+            registers.update(range(args.start, min(args.start + args.count, 0x10000)))
+        if not read_registers(config, sorted(registers), args.format, args.verbose):
+            sys.exit(1)
+        return
+
+    if args.register is None:
+        parser.error("one of --register, --start or --registers is required")
+
     # Create read frame
     frame = create_read_frame(config['inverter_sn'], args.register, verbose=args.verbose)
     
@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import signal
+import struct
+import sys
+import libscrc
+from array import array
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sofar_monitor_file = os.path.join(current_directory, "sofar-monitor.py")
+default_image_file = os.path.join(current_directory, "samples", "full_export.json")
+
+
+def load_sofar_monitor():
+    """Import sofar-monitor.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_monitor", sofar_monitor_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+sofar = load_sofar_monitor()
+
+HYD_FRAME_LENGTH = len(sofar.create_hyd_write_frame(0, 0))
+
+
+def finish_frame(frame):
+    """Fill in the checksum of a frame whose last two bytes are checksum and end code"""
+    frame[-2] = sum(frame[1:-2]) & 0xFF
+    return bytes(frame)
+
+def build_response_frame(request, rtu):
+    """Wrap a Modbus RTU response (without CRC) in a logger frame answering request"""
+    rtu += struct.pack('<H', libscrc.modbus(rtu))
+    # Data field: frame type, status, total working time, power on time, offset time
+    payload = b'\x02\x01' + bytes(12) + rtu
+    header = b'\xa5' + struct.pack('<H', len(payload)) + b'\x10\x15' + request[5:11]
+    return finish_frame(bytearray(header + payload + b'\x00\x15'))
+
+def read_response(request, image, start_register, num_registers):
+    """Build the response frame to a read of num_registers from start_register in image"""
+    if start_register + num_registers > 0x10000:
+        return build_response_frame(request, bytes([request[26], 0x83, 0x02]))
+    values = image.values[start_register:start_register + num_registers]
+    # Registers missing from the image read as zero, as on the inverter
+    words = [values[i] if image.present[start_register + i] else 0 for i in range(num_registers)]
+    return build_response_frame(request, bytes([request[26], 0x03, num_registers * 2]) +
+                                struct.pack(f'>{num_registers}H', *words))
+
+def load_captures(path):
+    """Load recorded responses from a capture file, grouped by (start, count)"""
+    captures = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                captures.setdefault((record['start'], record['count']), []).append(bytes.fromhex(record['response']))
+    return captures
+
+
+class LoggerSimulator:
+    """Answers logger read requests from a register image or recorded captures, with injected faults"""
+
+    def __init__(self, image, captures, args):
+        self.image = image
+        self.captures = captures
+        self.replayed = {}
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.connections = 0
+        self.stats = {'connections': 0, 'refused': 0, 'requests': 0, 'writes': 0, 'dropped': 0, 'truncated': 0,
+                      'corrupted': 0}
+
+    def chance(self, rate):
+        return rate > 0 and self.random.random() < rate
+
+    def answer(self, request):
+        """Build the response to a read or write request frame, or None if it is neither"""
+        if request[0] == 0x01:
+            return self.write_rtu(request)
+        if request[0] == 0x88:
+            return self.write_hyd(request)
+        if len(request) < 36 or libscrc.modbus(bytes(request[26:-2])) != 0:
+            return None
+        start, count = struct.unpack('>HH', request[28:32])
+        if request[27] == 0x10 and len(request) == 37 + count * 2:
+            return self.write(request, start, count)
+        if request[27] != 0x03 or len(request) != 36:
+            return None
+
+        recorded = self.captures.get((start, count))
+        if recorded:
+            # Replay the recorded responses of this range in order, looping at the end
+            index = self.replayed.get((start, count), 0)
+            self.replayed[(start, count)] = index + 1
+            frame = bytearray(recorded[index % len(recorded)])
+            frame[5:11] = request[5:11]
+            return finish_frame(frame)
+
+        return read_response(request, self.image, start, count)
+
+    def write(self, request, start, count):
+        """Store the values of a write request (function 0x10) and acknowledge it"""
+        if self.args.write_dialect != "v5":
+            return None
+        self.stats['writes'] += 1
+        if start + count > 0x10000:
+            return build_response_frame(request, bytes([request[26], 0x90, 0x02]))
+        self.image.update(start, array('H', struct.unpack(f'>{count}H', request[33:33 + count * 2])))
+        return build_response_frame(request, bytes([request[26], 0x10]) + request[28:32])
+
+    def write_rtu(self, request):
+        """Store the values of a bare RTU 0x10 frame and acknowledge it as an RTU device does"""
+        if self.args.write_dialect != "rtu" or libscrc.modbus(bytes(request)) != 0:
+            return None
+        self.stats['writes'] += 1
+        start, count = struct.unpack('>HH', request[2:6])
+        self.image.update(start, array('H', struct.unpack(f'>{count}H', request[7:7 + count * 2])))
+        return request[:6] + libscrc.modbus(bytes(request[:6])).to_bytes(2, 'little')
+
+    def write_hyd(self, request):
+        """Store the value of a HYD write frame; the acknowledgement echoes register, count and value"""
+        if self.args.write_dialect != "hyd":
+            return None
+        self.stats['writes'] += 1
+        register, count, value = struct.unpack('>HHH', request[3:9])
+        self.image.update(register, array('H', [value]))
+        return request[:9]
+
+    async def read_request(self, reader):
+        """Read one request: a frame in the logger framing, or a bare RTU or HYD write frame"""
+        first = await reader.readexactly(1)
+        if first == b'\x01':
+            # Slave, function, start, count, byte count, values, CRC
+            head = first + await reader.readexactly(6)
+            return head + await reader.readexactly(head[6] + 2)
+        if first == b'\x88':
+            return first + await reader.readexactly(HYD_FRAME_LENGTH - 1)
+        header = first + await reader.readexactly(sofar.HEADER_LENGTH - 1)
+        return header + await reader.readexactly(sofar.frame_length(header) - sofar.HEADER_LENGTH)
+
+    async def handle(self, reader, writer):
+        self.stats['connections'] += 1
+        if self.args.max_connections and self.connections >= self.args.max_connections:
+            # The logger stick serves only a few clients and resets the rest
+            self.stats['refused'] += 1
+            writer.close()
+            return
+
+        self.connections += 1
+        try:
+            while True:
+                request = await self.read_request(reader)
+                response = self.answer(request)
+                if response is None:
+                    continue
+                self.stats['requests'] += 1
+
+                if self.args.latency or self.args.jitter:
+                    await asyncio.sleep(self.args.latency + self.random.uniform(0, self.args.jitter))
+
+                if self.chance(self.args.drop_rate):
+                    self.stats['dropped'] += 1
+                    break
+                if self.chance(self.args.truncate_rate):
+                    self.stats['truncated'] += 1
+                    writer.write(response[:self.random.randrange(1, len(response))])
+                    await writer.drain()
+                    break
+                if self.chance(self.args.corrupt_rate) and response[0] == 0xA5:
+                    self.stats['corrupted'] += 1
+                    response = bytearray(response)
+                    response[self.random.randrange(25, len(response) - 2)] ^= 0xFF
+
+                # Send in small segments when asked to, like a congested Wi-Fi link
+                step = self.args.segment or len(response)
+                for i in range(0, len(response), step):
+                    writer.write(response[i:i + step])
+                    await writer.drain()
+
+        except (asyncio.IncompleteReadError, ConnectionError, sofar.FrameError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+async def serve(simulator, host, port):
+    server = await asyncio.start_server(simulator.handle, host, port)
+    print(f"Simulating logger on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a Sofar data logger (Solarman V5 framing) for testing.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8899, help="Port to listen on")
+    parser.add_argument("--image", default=default_image_file, help="Register image to answer reads from")
+    parser.add_argument("--replay", metavar="FILE", help="Capture file (from sofar-monitor.py --record) to replay")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds to wait before each response")
+    parser.add_argument("--jitter", type=float, default=0, help="Random extra latency of up to this many seconds")
+    parser.add_argument("--drop-rate", type=float, default=0, help="Share of requests answered by closing the connection")
+    parser.add_argument("--truncate-rate", type=float, default=0, help="Share of responses cut short before closing")
+    parser.add_argument("--corrupt-rate", type=float, default=0, help="Share of responses with a corrupted byte")
+    parser.add_argument("--segment", type=int, default=0, help="Send responses in segments of this many bytes")
+    parser.add_argument("--max-connections", type=int, default=0, help="Reset connections beyond this many (0: no limit)")
+    parser.add_argument("--write-dialect", choices=["v5", "rtu", "hyd"], default="v5",
+                        help="Write frames to accept; others are ignored, like a logger that does not know them")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible fault injection")
+    args = parser.parse_args()
+
+    image = sofar.load_register_image(args.image)
+    captures = load_captures(args.replay) if args.replay else {}
+    simulator = LoggerSimulator(image, captures, args)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        asyncio.run(serve(simulator, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(", ".join(f"{key}: {value}" for key, value in simulator.stats.items()))
+
+if __name__ == "__main__":
+    main()
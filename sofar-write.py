@@ -1,110 +1,96 @@
 #!/usr/bin/python3
 
-import socket
-import binascii
-import libscrc
-import configparser
 import argparse
-import time
+import importlib.util
+import os
 
-def padhex(s):
-    return '0x' + s[2:].zfill(4)
+current_directory = os.path.dirname(os.path.abspath(__file__))
+sofar_monitor_file = os.path.join(current_directory, "sofar-monitor.py")
+config_file = os.path.join(current_directory, "config.cfg")
 
-def hex_zfill(intval):
-    hexvalue = hex(intval)
-    return '0x' + str(hexvalue)[2:].zfill(4)
+def load_sofar_monitor():
+    """Import sofar-monitor.py as a module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("sofar_monitor", sofar_monitor_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
-def load_config(config_path='./config.cfg'):
-    """Load configuration from file"""
-    configParser = configparser.RawConfigParser()
-    configParser.read(config_path)
-    
-    return {
-        'inverter_ip': configParser.get('SofarInverter', 'inverter_ip'),
-        'inverter_port': int(configParser.get('SofarInverter', 'inverter_port')),
-        'inverter_sn': int(configParser.get('SofarInverter', 'inverter_sn')),
-        'verbose': configParser.get('SofarInverter', 'verbose')
-    }
+sofar = load_sofar_monitor()
 
-def create_write_frame(register, value, verbose=False):
-    """Create Modbus frame for writing according to Sofar HYD protocol"""
-    # Frame structure according to HYD protocol
-    frame = bytearray.fromhex('88 13 10')  # Start + length + function code
-    
-    # Convert register to hex and add to frame
-    reg_hex = hex(register)[2:].zfill(4)
-    frame.extend(bytearray.fromhex(reg_hex))
-    
-    # Add fixed length of 1
-    frame.extend(bytearray.fromhex('0001'))
-    
-    # Convert value to hex and add to frame
-    value_hex = hex(value)[2:].zfill(4)
-    frame.extend(bytearray.fromhex(value_hex))
-    
-    # Add the standard trailer for HYD protocol
-    frame.extend(bytearray.fromhex('005509C40A5A0014012C012CFFFFFFFF00000000000000000000000000000000'))
-    
-    # Calculate CRC16
-    crc = libscrc.modbus(frame[2:])  # Calculate CRC from function code onwards
-    frame.extend(bytearray.fromhex(f'{crc:04x}'))
-    
-    if verbose:
-        print(f"Write request: Register {hex(register)} = {value} ({value_hex})")
-        print(f"Frame to send: {frame.hex()}")
-    
-    return frame
+def parse_write(text):
+    """Parse a "register=value" pair, both decimal or 0x-prefixed hex"""
+    register, _, value = text.replace(' ', '=').partition('=')
+    register, value = int(register, 0), int(value, 0)
+    if not 0 <= register <= 0xFFFF or not 0 <= value <= 0xFFFF:
+        raise ValueError(f"register and value must be 0..0xFFFF: {text}")
+    return register, value
 
-def send_frame(ip, port, frame, verbose=False):
-    """Send a frame to the inverter and get response"""
-    try:
-        clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        clientSocket.settimeout(15)
-        clientSocket.connect((ip, port))
-        
-        if verbose:
-            print(f"Sending to {ip}:{port}")
-        
-        clientSocket.sendall(frame)
-        time.sleep(0.5)
-        
-        data = clientSocket.recv(1024)
-        
-        if not data:
-            print("No response received")
-            return None
-
-        if verbose:
-            print("Response received:", data.hex())
+def load_batch(path):
+    """Load "register=value" lines (or "register value"); # starts a comment"""
+    writes = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                register, value = parse_write(line)
+                writes[register] = value
+    return writes
 
-        clientSocket.close()
-        return data
+def write_batch(config, writes, verbose=False):
+    """Write all registers over one connection and report the values read back"""
+    with sofar.InverterSession(config['inverter_ip'], config['inverter_port'], verbose=verbose) as session:
+        # The first write to a logger finds out which write frames it accepts
+        dialect = sofar.get_write_dialect(session, config, min(writes), verbose)
+        if dialect is None:
+            print(f"The logger accepts none of the write dialects: {', '.join(sofar.WRITE_DIALECTS)}")
+            return False
+        results = sofar.write_registers(session, config['inverter_sn'], writes, verbose, dialect=dialect)
 
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
+    failed = 0
+    for register, value in sorted(writes.items()):
+        read_back = results[register]
+        if read_back == value:
+            print(f"{hex(register)} = {value}: confirmed")
+        else:
+            failed += 1
+            print(f"{hex(register)} = {value}: " + ("not confirmed" if read_back is None else f"read back {read_back}"))
+    print(f"\n{len(writes) - failed} of {len(writes)} register(s) written and confirmed")
+    return failed == 0
 
 def main():
     parser = argparse.ArgumentParser(description="Send write commands to Sofar HYD inverter.")
-    parser.add_argument("--register", type=lambda x: int(x, 0), required=True,
+    parser.add_argument("--register", type=lambda x: int(x, 0),
                       help="Register to write to (in hex, e.g., 0x800)")
-    parser.add_argument("--value", type=int, required=True,
+    parser.add_argument("--value", type=int,
                       help="Value to write to the register")
+    parser.add_argument("--set", action="append", type=parse_write, default=[], metavar="REGISTER=VALUE",
+                      help="Register and value to write in a batch (repeatable), e.g. 0x1100=2")
+    parser.add_argument("--batch", metavar="FILE",
+                      help="File with one REGISTER=VALUE per line to write in a batch")
     parser.add_argument("--verbose", action="store_true",
                       help="Enable verbose output")
+    parser.add_argument("--inverter",
+                      help="Name of the [SofarInverter:<name>] section to use (default: [SofarInverter] or the only section)")
     args = parser.parse_args()
 
-    config = load_config()
-    
-    print(f"Writing value {args.value} to register {hex(args.register)}...")
-    write_frame = create_write_frame(args.register, args.value, args.verbose)
-    response = send_frame(config['inverter_ip'], config['inverter_port'], 
-                         write_frame, args.verbose)
-    
-    if response:
-        print(f"\nWrite command sent. Please verify the change by reading register {hex(args.register)}")
-    else:
-        print("\nWrite command failed")
+    writes = load_batch(args.batch) if args.batch else {}
+    writes.update(args.set)
+    if args.register is not None or args.value is not None:
+        if args.register is None or args.value is None:
+            parser.error("--register and --value must be given together")
+        if not 0 <= args.register <= 0xFFFF or not 0 <= args.value <= 0xFFFF:
+            parser.error("register and value must be 0..0xFFFF")
+        writes[args.register] = args.value
+    if not writes:
+        parser.error("--register and --value, or --set/--batch are required")
+    try:
+        config = sofar.select_inverter(sofar.load_inverters(config_file), args.inverter)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Every write is verified by reading the register back
+    if not write_batch(config, writes, args.verbose):
+        raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import importlib.util
+import os
+import struct
+import threading
+
+import pytest
+
+repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+samples_directory = os.path.join(repo_directory, "samples")
+
+
+def load_script(path, name):
+    """Import a script of the repository as a module (the hyphenated file names are not valid module names)"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def sofar():
+    return load_script(os.path.join(repo_directory, "sofar-monitor.py"), "sofar_monitor")
+
+
+class RunningSimulator:
+    """A logger simulator serving on a free local port from a background thread"""
+
+    def __init__(self, image_path, **options):
+        self.module = module = load_script(os.path.join(repo_directory, "sofar-simulator.py"), "sofar_simulator")
+        args = argparse.Namespace(latency=0, jitter=0, drop_rate=0, truncate_rate=0, corrupt_rate=0, segment=0,
+                                  max_connections=0, write_dialect="v5", seed=0)
+        vars(args).update(options)
+        self.simulator = module.LoggerSimulator(module.sofar.load_register_image(image_path), {}, args)
+        self.reads = []  # (start, count) of every read request, in order
+        self.failing = set()  # start registers of the ranges answered with a Modbus exception
+        self.answer, self.simulator.answer = self.simulator.answer, self.record
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.simulator.handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def record(self, request):
+        if len(request) == 36 and request[27] == 0x03:
+            start, count = struct.unpack('>HH', request[28:32])
+            self.reads.append((start, count))
+            if start in self.failing:
+                # Slave device failure
+                return self.module.build_response_frame(request, bytes([request[26], 0x83, 0x04]))
+        return self.answer(request)
+
+    async def shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+@pytest.fixture
+def simulator():
+    running = RunningSimulator(os.path.join(samples_directory, "full_export.json"))
+    yield running
+    running.close()
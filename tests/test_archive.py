@@ -0,0 +1,91 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from conftest import samples_directory
+
+
+@pytest.fixture
+def images(sofar):
+    """Images a minute apart cycling through the samples, as (timestamp, image, expected archive state)"""
+    samples = [sofar.load_register_image(os.path.join(samples_directory, name))
+               for name in sorted(os.listdir(samples_directory))]
+    state = sofar.RegisterImage()
+    recorded = []
+    for i in range(10):
+        image = samples[i % len(samples)]
+        # Registers missing from an image keep their previous value
+        for start, words in sofar.register_blocks(image):
+            state.update(start, words)
+        recorded.append((1700000000.0 + i * 60, image, sofar.register_image_to_dict(state)))
+    return recorded
+
+
+def write_archive(sofar, path, images, keyframe_interval=4):
+    with sofar.RegisterArchive(str(path), keyframe_interval) as archive:
+        for timestamp, image, _ in images:
+            archive.append(timestamp, image)
+
+
+def test_round_trip(sofar, tmp_path, images):
+    path = tmp_path / "registers.archive"
+    write_archive(sofar, path, images)
+
+    # Keyframes at the first record and after every keyframe_interval - 1 deltas
+    assert [timestamp for timestamp, _ in sofar.read_archive_index(str(path))] == [images[i][0] for i in (0, 4, 8)]
+    read = [(timestamp, sofar.register_image_to_dict(image)) for timestamp, image in sofar.read_archive(str(path))]
+    assert read == [(timestamp, expected) for timestamp, _, expected in images]
+
+
+def test_time_range_starts_at_a_keyframe(sofar, tmp_path, images):
+    path = tmp_path / "registers.archive"
+    write_archive(sofar, path, images)
+
+    # The range starts after the second keyframe and ends between two records
+    read = [(timestamp, sofar.register_image_to_dict(image))
+            for timestamp, image in sofar.read_archive(str(path), start=images[5][0], end=images[7][0] + 30)]
+    assert read == [(timestamp, expected) for timestamp, _, expected in images[5:8]]
+
+
+def test_appending_continues_after_a_cut_short_record(sofar, tmp_path, images):
+    path = tmp_path / "registers.archive"
+    write_archive(sofar, path, images[:6])
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    # The cut record is dropped and appending continues from the state before it
+    write_archive(sofar, path, images[6:])
+    read = [(timestamp, sofar.register_image_to_dict(image)) for timestamp, image in sofar.read_archive(str(path))]
+    expected = images[:5] + images[6:]
+    assert [timestamp for timestamp, _ in read] == [timestamp for timestamp, _, _ in expected]
+    assert read[-1][1] == images[-1][2]
+
+
+def test_replay(sofar, tmp_path, images, capsys):
+    path = tmp_path / "registers.archive"
+    write_archive(sofar, path, images)
+
+    sofar.replay(str(path), "json")
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == len(images)
+    for line, (timestamp, _, expected) in zip(lines, images):
+        data = json.loads(line)
+        assert data.pop('timestamp') == datetime.fromtimestamp(timestamp).isoformat()
+        decoded = json.loads(json.dumps(sofar.format_data(sofar.register_image_from_dict(expected))))
+        del decoded['timestamp']
+        assert data == decoded
+
+
+def test_replay_of_a_capture(sofar, simulator, tmp_path):
+    plan = sofar.plan_for({'max_registers': 125, 'frame_cost': 16, 'gap_cost': 1})
+    path = tmp_path / "capture.jsonl"
+    with open(path, 'w') as capture, sofar.InverterSession("127.0.0.1", simulator.port) as session:
+        for _ in range(3):
+            polled = sofar.poll_registers(session, 0, plan, capture=capture)
+
+    recorded = list(sofar.read_recording(str(path)))
+    assert len(recorded) == 3
+    for _, image in recorded:
+        assert sofar.register_image_to_dict(image) == sofar.register_image_to_dict(polled)
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import load_script, repo_directory
+
+
+@pytest.fixture(scope="module")
+def control():
+    return load_script(os.path.join(repo_directory, "exporter", "control.py"), "control")
+
+
+def submit_in_order(queue, requests, timeout=5):
+    """Submit (writes, priority) requests from threads, one after the other; returns the threads"""
+    threads = []
+    for writes, priority in requests:
+        thread = threading.Thread(target=queue.submit, args=(writes, priority), daemon=True)
+        thread.start()
+        threads.append(thread)
+        deadline = time.monotonic() + timeout
+        while True:
+            # Under the queue's lock, so the request is seen once submit() has also set the flag
+            with queue.condition:
+                if len(queue.heap) == len(threads):
+                    break
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    return threads
+
+
+def test_lowest_priority_number_first_then_arrival_order(control, tmp_path):
+    queue = control.WriteQueue(str(tmp_path / "snapshot.json"), timeout=5)
+    threads = submit_in_order(queue, [({0x104D: 1}, 1), ({0x104D: 2}, 0), ({0x104D: 3}, 1), ({0x104D: 4}, 0)])
+
+    sent = []
+    while (request := queue.pop()) is not None:
+        sent.append(request.writes[0x104D])
+        request.finish({0x104D: request.writes[0x104D]})
+    assert sent == [2, 4, 1, 3]
+    for thread in threads:
+        thread.join(1)
+        assert not thread.is_alive()
+
+
+def test_flag_file_while_writes_are_pending(control, tmp_path):
+    snapshot_path = str(tmp_path / "snapshot.json")
+    queue = control.WriteQueue(snapshot_path, timeout=5)
+    other_worker = control.WriteQueue(snapshot_path, timeout=5)
+    assert not other_worker.pending_anywhere()
+
+    submit_in_order(queue, [({0x104D: 1}, 0)])
+    assert other_worker.pending_anywhere()
+    queue.pop().finish({0x104D: 1})
+    assert queue.pop() is None
+    assert not other_worker.pending_anywhere()
+
+    # A flag older than the timeout is left over from a worker that died
+    stale = f"{snapshot_path}.write.1"
+    open(stale, 'w').close()
+    os.utime(stale, (time.time() - 10, time.time() - 10))
+    assert not other_worker.pending_anywhere()
+
+
+def test_timed_out_request_is_dropped(control, tmp_path):
+    queue = control.WriteQueue(str(tmp_path / "snapshot.json"), timeout=0.1)
+    request = queue.submit({0x104D: 1}, 0)
+    assert request.cancelled and not request.done.is_set()
+    assert queue.pop() is None
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+from conftest import load_script, repo_directory
+
+pytest.importorskip("flask")
+
+
+def wait_for(condition, timeout=10):
+    """Wait until condition() returns something true, and return it"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError("timed out")
+
+
+def decoded(image, sofar):
+    """The data the exporter should serve for a register image, as stored in the snapshot"""
+    data = json.loads(json.dumps(sofar.format_data(image)))
+    del data['timestamp']
+    return data
+
+
+def served(snapshot):
+    data = dict(snapshot['data'])
+    del data['timestamp']
+    return data
+
+
+@pytest.fixture
+def exporter(simulator, tmp_path, monkeypatch):
+    """The exporter polling the simulator, run from a copy of the scripts next to its own config.cfg"""
+    shutil.copy(os.path.join(repo_directory, "sofar-monitor.py"), tmp_path)
+    shutil.copytree(os.path.join(repo_directory, "exporter"), tmp_path / "exporter",
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    (tmp_path / "config.cfg").write_text(
+        "[SofarInverter]\n"
+        f"inverter_ip = 127.0.0.1\ninverter_port = {simulator.port}\ninverter_sn = 0\n"
+        "[Exporter]\n"
+        f"snapshot_path = {tmp_path / 'snapshot.json'}\n"
+        "poll_interval = 0.4\nbackoff_max = 0.4\nslow_interval = 60\nstatic_interval = 3600\n"
+        "control = 1\nwrite_interval = 60\n")
+    monkeypatch.syspath_prepend(str(tmp_path / "exporter"))
+    module = load_script(str(tmp_path / "exporter" / "exporter_web_sever.py"), "exporter_web_sever")
+    yield module
+    for poller in module.pollers.values():
+        poller.interval = 1e6  # park the poller threads, which cannot be stopped
+
+
+def metric(client, name):
+    text = client.get('/metrics').get_data(as_text=True)
+    return next(float(line.split()[-1]) for line in text.splitlines() if line.startswith(f'sofar{{stats="{name}"}}'))
+
+
+def test_slow_tiers_are_not_read_every_cycle(exporter, simulator):
+    poller = exporter.pollers['inverter']
+    wait_for(lambda: poller.store.read() and poller.store.read()['state']['stats'].get('cycles', 0) >= 3)
+
+    for tier in ('slow', 'static'):
+        for reg_range in poller.tier_plans[tier]:
+            assert simulator.reads.count(reg_range) == 1
+    assert simulator.reads.count(poller.tier_plans['fast'][0]) >= 3
+    # The registers of the slower tiers are still decoded from the state
+    assert served(poller.store.read()) == decoded(simulator.simulator.image, exporter.sofar)
+
+
+def test_partial_cycle_serves_the_last_good_data_as_stale(exporter, simulator):
+    poller = exporter.pollers['inverter']
+    client = exporter.app.test_client()
+    good = wait_for(lambda: poller.store.read())
+    assert metric(client, "stale") == 0
+
+    # One range fails while a register of another range changes: nothing of that cycle may show up
+    failing, changing = poller.tier_plans['fast'][0], poller.tier_plans['fast'][1]
+    reg = next(reg for reg in exporter.sofar.DECODER_REGISTERS if changing[0] <= reg < changing[0] + changing[1])
+    simulator.failing.add(failing[0])
+    simulator.simulator.image.values[reg] += 1
+
+    failed = wait_for(lambda: (snapshot := poller.store.read())['failures'] >= 2 and snapshot)
+    assert failed['data'] == good['data']
+    assert failed['timestamp'] == good['timestamp']
+    assert metric(client, "stale") == 1
+    assert metric(client, "poll_failures") >= 2
+
+    simulator.failing.clear()
+    recovered = wait_for(lambda: (snapshot := poller.store.read())['failures'] == 0 and snapshot)
+    assert served(recovered) != served(good)
+    assert served(recovered) == decoded(simulator.simulator.image, exporter.sofar)
+    assert metric(client, "stale") == 0
+
+
+def test_control_writes_are_read_back_and_rate_limited(exporter, simulator):
+    client = exporter.app.test_client()
+    wait_for(lambda: exporter.pollers['inverter'].store.read())
+
+    response = client.post('/control', json={'registers': {'0x104D': 25, '0x104E': 85}, 'priority': 0})
+    assert response.status_code == 200
+    assert response.get_json() == {'registers': {'0x104D': 25, '0x104E': 85}, 'confirmed': True}
+    assert simulator.simulator.image[0x104D] == 25 and simulator.simulator.image[0x104E] == 85
+
+    response = client.post('/control', json={'registers': {'0x104D': 30}})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert simulator.simulator.image[0x104D] == 25
+
+    assert client.post('/control', json={'registers': {'0x104D': 0x10000}}).status_code == 400
@@ -0,0 +1,70 @@
+import json
+import time
+
+
+def test_fresh_snapshot_is_not_polled_again(sofar, tmp_path):
+    store = sofar.SnapshotStore(str(tmp_path / "snap.json"), ttl=60)
+    polls = []
+    store.refresh(lambda state: polls.append(1) or {'value': 1})
+    snapshot = store.refresh(lambda state: polls.append(1) or {'value': 2})
+    assert len(polls) == 1
+    assert snapshot['data'] == {'value': 1}
+
+
+def test_failed_cycles_back_off_and_keep_the_last_data(sofar, tmp_path):
+    store = sofar.SnapshotStore(str(tmp_path / "snap.json"), ttl=10, backoff_max=35)
+    store.write({'timestamp': time.time() - 60, 'data': {'value': 1}, 'failures': 0, 'retry_at': 0})
+
+    for failures, backoff in [(1, 10), (2, 20), (3, 35), (4, 35)]:
+        before = time.time()
+        snapshot = store.refresh(lambda state: None)
+        assert snapshot['failures'] == failures
+        assert snapshot['data'] == {'value': 1}
+        assert before + backoff <= snapshot['retry_at'] <= time.time() + backoff
+
+        # While the circuit is open the stale snapshot is served without polling
+        polls = []
+        assert store.refresh(lambda state: polls.append(1)) == snapshot
+        assert polls == []
+
+        snapshot['retry_at'] = 0  # let the backoff run out
+        store.write(snapshot)
+
+    snapshot = store.refresh(lambda state: {'value': 2})
+    assert snapshot['data'] == {'value': 2}
+    assert snapshot['failures'] == 0
+    assert not store.is_backing_off(snapshot)
+
+
+def test_yielded_cycle_leaves_the_snapshot(sofar, tmp_path):
+    path = tmp_path / "snap.json"
+    store = sofar.SnapshotStore(str(path), ttl=10)
+    store.write({'timestamp': time.time() - 60, 'data': {'value': 1}, 'failures': 0, 'retry_at': 0})
+    saved = path.read_text()
+
+    snapshot = store.refresh(lambda state: sofar.POLL_YIELDED)
+    assert snapshot['data'] == {'value': 1}
+    assert path.read_text() == saved
+    assert json.loads(saved)['failures'] == 0
+
+
+def test_state_is_carried_between_cycles(sofar, tmp_path):
+    store = sofar.SnapshotStore(str(tmp_path / "snap.json"), ttl=0)
+
+    def poll(state):
+        state['cycles'] = state.get('cycles', 0) + 1
+        return {'cycles': state['cycles']}
+
+    store.refresh(poll)
+    assert store.refresh(poll)['data'] == {'cycles': 2}
+
+
+def test_cycle_budget_skips_the_remaining_ranges(sofar, simulator):
+    plan = [(0x0404, 10), (0x0484, 10), (0x0504, 10), (0x0584, 10)]
+    simulator.simulator.args.latency = 0.2
+    started = time.monotonic()
+    with sofar.InverterSession("127.0.0.1", simulator.port) as session:
+        values = sofar.poll_registers(session, 0, plan, budget=0.5)
+    assert time.monotonic() - started < 1
+    assert 0x0404 in values
+    assert 0x0584 not in values
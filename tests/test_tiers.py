@@ -0,0 +1,26 @@
+CONFIG = {'max_registers': 125, 'frame_cost': 16, 'gap_cost': 1}
+
+
+def test_every_register_is_planned_in_its_tier(sofar):
+    tier_plans = sofar.plan_tiers(CONFIG)
+    assert set(tier_plans) == set(sofar.TIERS)
+    for reg in sofar.DECODER_REGISTERS:
+        tier = sofar.register_tier(reg)
+        assert any(start <= reg < start + count for start, count in tier_plans[tier])
+    for tier, plan in tier_plans.items():
+        for start, count in plan:
+            assert count <= CONFIG['max_registers']
+            registers = [reg for reg in sofar.DECODER_REGISTERS if start <= reg < start + count]
+            assert registers and all(sofar.register_tier(reg) == tier for reg in registers)
+
+
+def test_due_tiers(sofar):
+    tier_plans = sofar.plan_tiers(CONFIG)
+    intervals = {'fast': 0, 'slow': 60, 'static': 3600}
+    now = 10000
+
+    assert sofar.due_tiers(tier_plans, {}, intervals, now) == list(tier_plans)
+    last_polled = {'fast': now - 1, 'slow': now - 59, 'static': now - 3600}
+    assert sofar.due_tiers(tier_plans, last_polled, intervals, now) == ['fast', 'static']
+    last_polled = {'fast': now, 'slow': now - 60, 'static': now - 1}
+    assert sofar.due_tiers(tier_plans, last_polled, intervals, now) == ['fast', 'slow']
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+
+def test_hyd_reply_echoes_register_count_and_value(sofar):
+    frame = sofar.create_hyd_write_frame(0x104D, 25)
+    assert sofar.is_hyd_write_reply(frame[:9], frame)
+    assert sofar.is_hyd_write_reply(frame, frame)
+    assert not sofar.is_hyd_write_reply(None, frame)
+    assert not sofar.is_hyd_write_reply(frame[:8], frame)
+    assert not sofar.is_hyd_write_reply(sofar.create_hyd_write_frame(0x104D, 26)[:9], frame)
+    assert not sofar.is_hyd_write_reply(sofar.create_hyd_write_frame(0x104E, 25)[:9], frame)
+
+
+def test_rtu_reply_echoes_start_and_count_with_crc(sofar):
+    frame = sofar.create_rtu_write_frame(0x104D, [25, 85])
+    reply = frame[:6] + sofar.libscrc.modbus(bytes(frame[:6])).to_bytes(2, 'little')
+    assert sofar.is_rtu_write_reply(reply, frame)
+    assert not sofar.is_rtu_write_reply(reply[:6] + bytes(2), frame)
+    assert not sofar.is_rtu_write_reply(sofar.create_rtu_write_frame(0x104D, [25])[:6] + reply[6:], frame)
+
+
+@pytest.mark.parametrize("dialect", ["v5", "rtu", "hyd"])
+def test_write_in_every_dialect(sofar, simulator, dialect):
+    simulator.simulator.args.write_dialect = dialect
+    with sofar.InverterSession("127.0.0.1", simulator.port) as session:
+        results = sofar.write_registers(session, 0, {0x104D: 25, 0x104E: 85, 0x1050: 7}, dialect=dialect)
+    assert results == {0x104D: 25, 0x104E: 85, 0x1050: 7}
+    assert simulator.simulator.image[0x1050] == 7
+
+
+def test_hyd_write_with_a_wrong_echo_is_not_acknowledged(sofar, simulator):
+    simulator.simulator.args.write_dialect = "hyd"
+    write_hyd = simulator.simulator.write_hyd
+    # A logger that stores the value but echoes another one
+    simulator.simulator.write_hyd = lambda request: write_hyd(request)[:8] + b'\x00'
+    with sofar.InverterSession("127.0.0.1", simulator.port) as session:
+        assert not sofar.send_write(session, 0, 0x104D, [25], "hyd")
+        assert sofar.write_registers(session, 0, {0x104D: 25}, dialect="hyd") == {0x104D: None}
+
+
+@pytest.mark.parametrize("dialect", ["v5", "rtu", "hyd"])
+def test_dialect_is_probed_once_and_cached(sofar, simulator, tmp_path, monkeypatch, dialect):
+    monkeypatch.setattr(sofar, "PROBE_TIMEOUT", 0.3)
+    simulator.simulator.args.write_dialect = dialect
+    value = simulator.simulator.image[0x104D]
+    config = {'inverter_sn': 1234, 'write_dialect': "auto", 'dialect_cache': str(tmp_path / "dialects.json")}
+
+    with sofar.InverterSession("127.0.0.1", simulator.port) as session:
+        assert sofar.get_write_dialect(session, config, 0x104D) == dialect
+        # The probe writes the current value back
+        assert simulator.simulator.image[0x104D] == value
+        assert json.loads((tmp_path / "dialects.json").read_text()) == {"1234": dialect}
+
+        writes = simulator.simulator.stats['writes']
+        assert sofar.get_write_dialect(session, config, 0x104D) == dialect
+        assert simulator.simulator.stats['writes'] == writes
+
+
+def test_no_dialect_is_cached_when_none_works(sofar, simulator, tmp_path, monkeypatch):
+    monkeypatch.setattr(sofar, "PROBE_TIMEOUT", 0.3)
+    simulator.simulator.args.write_dialect = "none"
+    config = {'inverter_sn': 1234, 'write_dialect': "auto", 'dialect_cache': str(tmp_path / "dialects.json")}
+    with sofar.InverterSession("127.0.0.1", simulator.port) as session:
+        assert sofar.get_write_dialect(session, config, 0x104D) is None
+    assert not (tmp_path / "dialects.json").exists()